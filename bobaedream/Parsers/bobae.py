@@ -4,8 +4,9 @@ from datetime import datetime
 from math import ceil
 from pathlib import Path
 
-import aiofiles
-from bs4 import BeautifulSoup
+from configs import config
+from Parsers.markup import get_executor, parse_listing
+from Utils.worker_pool import WorkerPool
 
 ROOT_DIR = Path('share')
 ROOT_DIR.mkdir(exist_ok=True)
@@ -37,147 +38,170 @@ class BobaParser:
         '해치백'
     )
 
-    def __init__(self, request_dispatcher, database):
+    def __init__(self, request_dispatcher, database, writer, photo_store):
         self.request_dispatcher = request_dispatcher
+        self.photo_store = photo_store
         self.database = database
+        self.writer = writer
+        self.executor = None
         self.body = None
-        self.cars = []
 
     async def parse(self):
-        for type_ in self.TYPES:
-            for body_ in self.BODY_TYPES:
-                self.body = body_
-                page = 1
-                pages = 1
-                attempts = 2
-                while True:
-                    if page > pages:
-                        break
-
-                    try:
-                        async with self.request_dispatcher.get(
-                            self.URL.format(
-                                type_=type_,
-                                body_=body_,
-                                page=page
-                            )
-                        ) as resp:
-                            if resp.ok:
-                                soup = BeautifulSoup(
-                                    await resp.read(),
-                                    'html.parser'
-                                )
-                                total, pages = (
-                                    await self.get_total_records_and_pages(
-                                        soup
-                                    )
-                                )
-
-                            if total == 0:
-                                break
-
-                            await self.parse_cars(soup.find('div', id='listCont'))
-
-                    except AttributeError:
-                        if attempts == 0:
-                            break
-
-                        attempts -= 1
-
-                    page += 1
-
-                if self.cars:
-                    await self.database.cars_processing(self.cars)
-                    self.cars.clear()
-
-    async def parse_cars(self, html):
-        tasks = []
-        for car in html.find_all('li', class_='product-item'):
-            if car.find('p', class_='tit').text.strip().startswith('미니'):
-                continue
+        # Pages are parsed in a pool, so the event loop keeps serving
+        # requests while a page is being turned into records.
+        with get_executor() as self.executor:
+            await self.parse_body_types()
+
+    async def parse_body_types(self):
+        # Domestic and imported listings share body types, so both are
+        # collected before the body type is written and swept.
+        for body_ in self.BODY_TYPES:
+            self.body = body_
+            # Photos get their own pool, so a page task hands its cars over
+            # and frees its slot for the next page instead of waiting for
+            # forty downloads.
+            async with WorkerPool(config.workers.size) as photos:
+                complete = all(
+                    await asyncio.gather(
+                        *(
+                            self.parse_type(type_, body_, photos)
+                            for type_ in self.TYPES
+                        )
+                    )
+                )
 
-            tasks.append(
-                asyncio.create_task(
-                    self.parse_car(car)
+            if not complete:
+                print(
+                    f'{await self.time()} - [ SWEEP ] Skipped for the body {body_}: some requests failed.'
                 )
-            )
+                continue
+
+            await self.writer.finish_body_type('bobaedream', body_)
+
+    async def parse_type(self, type_, body_, photos):
+        listing = await self.get_page(type_, body_, 1)
+        if listing is None:
+            return False
+
+        total, pages = await self.get_total_records_and_pages(listing)
+        if total == 0:
+            return True
 
-        self.cars += await asyncio.gather(*tasks)
+        await self.parse_cars(listing, photos)
+        # The first page gives the total, so every other page URL is known
+        # and they are all requested at once under the dispatcher limits.
+        async with WorkerPool(config.workers.size) as pool:
+            for page in range(2, pages + 1):
+                await pool.submit(self.parse_page(type_, body_, page, photos))
 
-    async def parse_car(self, html):
+        return not pool.errors and all(pool.results)
+
+    async def parse_page(self, type_, body_, page, photos):
+        listing = await self.get_page(type_, body_, page)
+        if listing is None:
+            return False
+
+        await self.parse_cars(listing, photos)
+        return True
+
+    async def get_page(self, type_, body_, page):
+        attempts = 2
+        while True:
+            try:
+                content = None
+                async with self.request_dispatcher.get(
+                    self.URL.format(type_=type_, body_=body_, page=page)
+                ) as resp:
+                    if resp is not None and resp.ok:
+                        content = await resp.read()
+
+                # Parsed after the response is closed: an open response
+                # holds one of the host's limiter slots while the page waits
+                # for the pool.
+                if content is not None:
+                    listing = await self.read_listing(content)
+                    if listing is not None:
+                        return listing
+
+            except Exception as error:
+                print(f'{await self.time()} - [ ERROR ] {error}')
+
+            if attempts == 0:
+                return None
+
+            attempts -= 1
+
+    async def read_listing(self, content):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, parse_listing, content
+        )
+
+    async def parse_cars(self, listing, photos):
+        for item in listing['cars']:
+            if (item['title'] or '').strip().startswith('미니'):
+                continue
+
+            try:
+                car = await self.parse_car(item)
+            except Exception as error:
+                print(f'{await self.time()} - [ ERROR ] {error!r}')
+                continue
+
+            await photos.submit(self.store_car(car))
+
+    async def store_car(self, car):
+        if car['preview']:
+            car['preview'] = await self.download_photo(car)
+
+        await self.writer.put(car)
+
+    async def parse_car(self, item):
         car = {}
         car['source'] = 'bobaedream'
         car['id'] = int(re.search(
             r'no=(?P<carid>\d+)&',
-            html.find('p', class_='tit').find('a')['href']
+            item['href']
         ).group('carid'))
 
         print(f'{await self.time()} - Parsing car: [ {car["id"]} ]')
 
-        cardir = ROOT_DIR.joinpath(f'bobaedream_{car["id"]}')
-        cardir.mkdir(parents=True, exist_ok=True)
-
         car['preview'] = await self.extract_preview(
-            html
-            .find('div', class_='mode-cell thumb')
-            .find('img')['src'],
-            cardir
-        ) if html.find('div', class_='mode-cell thumb').find('img') else None
+            item['thumb']
+        ) if item['thumb'] else None
 
         car['body_type'] = self.body
         car['mark'], car['model'], *car['grade'] = await self.extract_mark_model_grade(
-            html.find('p', class_='tit').text
+            item['title']
         )
         car['grade'] = ' '.join(car['grade']) if car['grade'] else None
-        car['gearbox'] = html.find(
-            'dd', class_='data-item').text
+        car['gearbox'] = item['gearbox']
         car['transmission'] = await self.extract_transmission(
-            html.find('dl', class_='data is-list').text
+            item['data']
         )
         car['engine'] = await self.extract_engine_volume(
             car['grade']
         ) if car['grade'] else None
         car['year'] = await self.extract_year(
-            html.find('div', class_='mode-cell year').text
+            item['year']
         )
-        car['fuel'] = html.find(
-            'div', class_='mode-cell fuel').text.strip()
+        car['fuel'] = item['fuel'].strip()
         car['mileage'] = await self.extract_mileage(
-            html.find('div', class_='mode-cell km').text
+            item['km']
         )
         car['price'] = await self.extract_price(
-            html.find('div', class_='mode-cell price').text
+            item['price']
         )
         return car
 
-    async def extract_preview(self, string, car_dir):
-        if 'cybercar' in string.lower():
-            url = 'https:' + string.replace('thum5', 'img').replace('.jpg', '_1.jpg')
-        else:
-            url = 'https:' + string.replace('_s1', '')
-
-        attempts = 2
-        while True:
-            try:
-                async with self.request_dispatcher.get(url) as resp:
-                    if resp.ok:
-                        path_to_photo = car_dir.joinpath(Path(url).name)
-                        async with aiofiles.open(path_to_photo, 'wb') as f:
-                            await f.write(await resp.read())
-
-                        return str(path_to_photo)
-
-            except Exception as error:
-                print(f'{await self.time()} - [ ERROR ] {error}')
-                if attempts == 0:
-                    return None
-
-                await asyncio.sleep(3)
-                attempts -= 1
+    async def download_photo(self, car):
+        return await self.photo_store.get(
+            car['preview'],
+            ROOT_DIR.joinpath(f'bobaedream_{car["id"]}', Path(car['preview']).name)
+        )
 
-    async def get_total_records_and_pages(self, html):
+    async def get_total_records_and_pages(self, listing):
         total = int(
-            html.find('span', id='tot').text
+            listing['total']
             .replace(",", "")
             .replace(".", "")
         )
@@ -185,6 +209,13 @@ class BobaParser:
         print(f'{await self.time()} - [ PAGES ] {pages} - [ TOTAL ] {total}')
         return total, pages
 
+    @staticmethod
+    async def extract_preview(string):
+        if 'cybercar' in string.lower():
+            return 'https:' + string.replace('thum5', 'img').replace('.jpg', '_1.jpg')
+
+        return 'https:' + string.replace('_s1', '')
+
     @staticmethod
     async def extract_mark_model_grade(string):
         INCORRECT_WORDS = ('더', '뉴', '어메이징', '올', '디')
@@ -0,0 +1,179 @@
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from time import perf_counter
+
+from bs4 import BeautifulSoup, UnicodeDammit
+from configs import config
+from lxml import html as lxml_html
+from lxml.etree import ParserError
+
+
+# Text nodes BeautifulSoup's .text counts: those outside script, style and
+# template elements.
+TEXT = './/text()[not(ancestor::script or ancestor::style or ancestor::template)]'
+
+
+def has_class(*names):
+    return ' and '.join(
+        f'contains(concat(" ", normalize-space(@class), " "), " {name} ")'
+        for name in names
+    )
+
+
+class SoupMarkup:
+    name = 'bs4'
+
+    def listing(self, content):
+        soup = BeautifulSoup(content, 'html.parser')
+        total = soup.find('span', id='tot')
+        container = soup.find('div', id='listCont')
+        if total is None or container is None:
+            return None
+
+        return {
+            'total': total.text,
+            'cars': [
+                self.item(item)
+                for item in container.find_all('li', class_='product-item')
+            ],
+        }
+
+    def item(self, item):
+        title = item.find('p', class_='tit')
+        link = title.find('a') if title else None
+        thumb = item.find('div', class_='mode-cell thumb')
+        image = thumb.find('img') if thumb else None
+        return {
+            'title': title.text if title else None,
+            'href': link.get('href') if link else None,
+            'thumb': image.get('src') if image else None,
+            'gearbox': self.text(item.find('dd', class_='data-item')),
+            'data': self.text(item.find('dl', class_='data is-list')),
+            'year': self.text(item.find('div', class_='mode-cell year')),
+            'fuel': self.text(item.find('div', class_='mode-cell fuel')),
+            'km': self.text(item.find('div', class_='mode-cell km')),
+            'price': self.text(item.find('div', class_='mode-cell price')),
+        }
+
+    @staticmethod
+    def text(node):
+        return node.text if node else None
+
+
+class LxmlMarkup:
+    # Same extraction as SoupMarkup, but the tree is built by libxml2 and
+    # searched with XPath, which is several times faster than html.parser.
+    name = 'lxml'
+
+    def listing(self, content):
+        # libxml2 falls back to latin-1 for pages without a charset meta;
+        # decode the way BeautifulSoup does so both see the same text.
+        try:
+            tree = lxml_html.document_fromstring(
+                UnicodeDammit(content, is_html=True).unicode_markup
+            )
+        except ParserError:
+            # An empty body; html.parser gives an empty soup for it.
+            return None
+
+        total = tree.xpath('//span[@id="tot"]')
+        container = tree.xpath('//div[@id="listCont"]')
+        if not total or not container:
+            return None
+
+        return {
+            'total': self.text(total[0]),
+            'cars': [
+                self.item(item)
+                for item in container[0].xpath(
+                    f'.//li[{has_class("product-item")}]'
+                )
+            ],
+        }
+
+    def item(self, item):
+        title = self.find(item, 'p', 'tit')
+        link = self.find(title, 'a')
+        image = self.find(self.find(item, 'div', 'mode-cell', 'thumb'), 'img')
+        return {
+            'title': self.text(title),
+            'href': link.get('href') if link is not None else None,
+            'thumb': image.get('src') if image is not None else None,
+            'gearbox': self.text(self.find(item, 'dd', 'data-item')),
+            'data': self.text(self.find(item, 'dl', 'data', 'is-list')),
+            'year': self.text(self.find(item, 'div', 'mode-cell', 'year')),
+            'fuel': self.text(self.find(item, 'div', 'mode-cell', 'fuel')),
+            'km': self.text(self.find(item, 'div', 'mode-cell', 'km')),
+            'price': self.text(self.find(item, 'div', 'mode-cell', 'price')),
+        }
+
+    @staticmethod
+    def find(node, tag, *classes):
+        if node is None:
+            return None
+
+        found = node.xpath(
+            f'.//{tag}[{has_class(*classes)}]' if classes else f'.//{tag}'
+        )
+        return found[0] if found else None
+
+    @staticmethod
+    def text(node):
+        if node is None:
+            return None
+
+        # BeautifulSoup collapses a whitespace-only string to one newline or
+        # one space; do the same so both backends return the same text.
+        return ''.join(
+            text if text.strip() else '\n' if '\n' in text else ' '
+            for text in node.xpath(TEXT)
+        )
+
+
+BACKENDS = {backend.name: backend for backend in (SoupMarkup, LxmlMarkup)}
+
+
+def parse_listing(content, name=None):
+    # Runs inside the parse pool: plain bytes in, plain records out.
+    return BACKENDS[name or config.html.backend]().listing(content)
+
+
+def get_executor():
+    # lxml releases the GIL while it builds the tree, so threads are enough
+    # for it; html.parser is pure Python and needs processes.
+    if config.html.pool == 'thread':
+        return ThreadPoolExecutor(config.html.workers)
+
+    return ProcessPoolExecutor(config.html.workers)
+
+
+def main(paths):
+    # Parity check and benchmark over saved listing pages:
+    #   python -m Parsers.markup samples/*.html
+    if not paths:
+        print('Usage: python -m Parsers.markup PAGE.html [PAGE.html ...]')
+        return False
+
+    pages = [Path(path).read_bytes() for path in paths]
+    results = {}
+    for name, backend in BACKENDS.items():
+        markup = backend()
+        start = perf_counter()
+        results[name] = [markup.listing(page) for page in pages]
+        elapsed = perf_counter() - start
+        print(f'[ BENCHMARK ] {name}: {len(pages) / elapsed:.1f} pages/s')
+
+    ok = True
+    reference, *others = BACKENDS
+    for name in others:
+        for path, expected, actual in zip(paths, results[reference], results[name]):
+            if expected != actual:
+                ok = False
+                print(f'[ PARITY ] {path}: {reference} and {name} differ')
+
+    return ok
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main(sys.argv[1:]) else 1)
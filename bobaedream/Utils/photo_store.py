@@ -0,0 +1,127 @@
+import asyncio
+import hashlib
+import os
+from datetime import datetime
+from pathlib import Path
+from time import time
+from uuid import uuid4
+
+import aiofiles
+from configs import config
+
+ROOT_DIR = Path("share")
+
+
+class PhotoStore:
+    # Photos are stored once under share/photos/<hash> and hardlinked into
+    # the share/<source>_<id>/ paths the site reads, so a URL seen before
+    # costs no request and identical images cost no disk.
+    def __init__(self, request_dispatcher, root=ROOT_DIR):
+        self.request_dispatcher = request_dispatcher
+        self.root = root
+        self.blobs = root.joinpath("photos")
+        self.index = dict()
+        self.pending = dict()
+        self.hits = 0
+        self.downloads = 0
+
+    def start(self, state=None):
+        if state and (snapshot := state.get("photos")):
+            self.restore(snapshot)
+
+    def snapshot(self):
+        print(
+            f'{datetime.now().strftime("%d-%m-%Y %H:%M:%S")} - [ PHOTOS ] {self.hits} reused, {self.downloads} downloaded'
+        )
+        # URLs not requested for max_age are listings that left the site;
+        # dropping them keeps the index the size of the live inventory.
+        expired = time() - config.photos.max_age
+        return {
+            key: [blob, used_at]
+            for key, (blob, used_at) in self.index.items()
+            if used_at >= expired
+        }
+
+    def restore(self, snapshot):
+        # Indexes saved before entries carried a last-use time start their
+        # age now.
+        now = time()
+        self.index.update(
+            (key, [entry, now] if isinstance(entry, str) else entry)
+            for key, entry in snapshot.items()
+        )
+
+    async def get(self, url, path, params=None):
+        # Returns the stored path of the photo, or None if it could not be
+        # downloaded. The key includes params, which change the image.
+        key = f"{url}?{sorted(params.items())}" if params else url
+        blob = self.index[key][0] if key in self.index else None
+        if blob is None or not self.blobs.joinpath(blob).exists():
+            # Concurrent requests for one URL (encar copies of a listing)
+            # share a single download.
+            if (task := self.pending.get(key)) is None:
+                task = self.pending[key] = asyncio.create_task(
+                    self.download(url, params)
+                )
+                task.add_done_callback(lambda _: self.pending.pop(key, None))
+
+            blob = await asyncio.shield(task)
+            if blob is None:
+                return None
+
+        else:
+            self.hits += 1
+
+        self.index[key] = [blob, time()]
+
+        self.link(self.blobs.joinpath(blob), path)
+        return str(path)
+
+    async def download(self, url, params=None):
+        attempts = 2
+        while True:
+            try:
+                async with self.request_dispatcher.get(url=url, params=params) as resp:
+                    if resp is not None and resp.ok:
+                        return await self.put(await resp.read(), Path(url).suffix)
+
+            except Exception as error:
+                print(
+                    f'{datetime.now().strftime("%d-%m-%Y %H:%M:%S")} - [ ERROR ] {error}'
+                )
+
+            if attempts == 0:
+                return None
+
+            await asyncio.sleep(2)
+            attempts -= 1
+
+    async def put(self, content, suffix):
+        digest = hashlib.sha256(content).hexdigest()
+        blob = f"{digest[:2]}/{digest}{suffix}"
+        blob_path = self.blobs.joinpath(blob)
+        self.downloads += 1
+        if not blob_path.exists():
+            blob_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = blob_path.with_name(f"{blob_path.name}.{uuid4().hex}.tmp")
+            async with aiofiles.open(tmp_path, "wb") as f:
+                await f.write(content)
+
+            os.replace(tmp_path, blob_path)
+
+        return blob
+
+    @staticmethod
+    def link(blob_path, path):
+        if path.exists() and path.samefile(blob_path):
+            return
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{uuid4().hex}.tmp")
+        try:
+            os.link(blob_path, tmp_path)
+        except OSError:
+            # Filesystems without hardlinks get a copy instead.
+            tmp_path.write_bytes(blob_path.read_bytes())
+
+        os.replace(tmp_path, path)
@@ -1,25 +1,188 @@
-from random import choice
-
-import requests
+import asyncio
+from datetime import datetime
+from math import ceil
+from random import choices
+from time import monotonic, time
+from urllib.parse import urlsplit
 
+from aiohttp import ClientTimeout
 from configs import config
 
 
+class ProxyHealth:
+    def __init__(self):
+        self.latency = None
+        self.success_rate = 1.0
+        self.failures = 0
+        self.cooldown_until = 0.0
+
+    def weight(self, now):
+        if self.cooldown_until > now:
+            return 0.0
+
+        latency = self.latency or config.proxy.default_latency
+        return max(self.success_rate, config.proxy.min_success_rate) / latency
+
+    def record(self, latency, ok):
+        alpha = config.proxy.ewma_alpha
+        self.success_rate = (1 - alpha) * self.success_rate + alpha * ok
+        if ok:
+            self.failures = 0
+            self.latency = (
+                latency
+                if self.latency is None
+                else (1 - alpha) * self.latency + alpha * latency
+            )
+            return
+
+        self.failures += 1
+        if self.failures >= config.proxy.quarantine_after:
+            cooldown = config.proxy.cooldown * 2 ** (
+                self.failures - config.proxy.quarantine_after
+            )
+            self.cooldown_until = monotonic() + min(
+                cooldown, config.proxy.max_cooldown
+            )
+
+
 class ProxyDispatcher:
     def __init__(self):
-        self.proxies = self.get_proxies()
+        self.proxies = []
+        self.health = dict()
+        self.session = None
+        self.refresh_task = None
+
+    async def start(self, session, state=None):
+        self.session = session
+        if state and (snapshot := state.get("proxy_pool")):
+            # Serve the saved pool straight away and reload it in background.
+            self.restore(snapshot)
+            self.refresh_task = asyncio.create_task(self.refresh_periodically(0))
+            return
+
+        await self.refresh()
+        self.refresh_task = asyncio.create_task(
+            self.refresh_periodically(config.proxy.refresh_interval)
+        )
+
+    async def stop(self):
+        if self.refresh_task:
+            self.refresh_task.cancel()
+            await asyncio.gather(self.refresh_task, return_exceptions=True)
+
+    async def refresh_periodically(self, delay):
+        while True:
+            await asyncio.sleep(delay)
+            await self.refresh()
+            delay = config.proxy.refresh_interval
 
-    def get_proxies(self):
-        with requests.get(
+    async def refresh(self):
+        try:
+            proxies = await self.get_proxies()
+        except Exception as error:
+            if not self.proxies:
+                raise
+
+            print(
+                f'{datetime.now().strftime("%d-%m-%Y %H:%M:%S")} - [ PROXY ERROR ] {error} - keeping {len(self.proxies)} proxies'
+            )
+            return
+
+        if not proxies:
+            return
+
+        # Swap in a new list object so a concurrent get_proxy never sees a
+        # half-built pool.
+        self.proxies = proxies
+        print(
+            f'{datetime.now().strftime("%d-%m-%Y %H:%M:%S")} - [ PROXIES ] {len(proxies)} loaded'
+        )
+
+    async def get_proxies(self):
+        first = await self.get_page(1)
+        pages = ceil(first["count"] / config.proxy.page_size)
+        rest = await asyncio.gather(
+            *(self.get_page(page) for page in range(2, pages + 1))
+        )
+        return [
+            f'http://{data["username"]}:{data["password"]}@{data["proxy_address"]}:{data["port"]}'
+            for webshare_response in (first, *rest)
+            for data in webshare_response["results"]
+            if data.get("valid", True)
+        ]
+
+    async def get_page(self, page):
+        async with self.session.get(
             url=config.proxy.url,
+            params={
+                "mode": "direct",
+                "page": page,
+                "page_size": config.proxy.page_size,
+            },
             headers={"Authorization": f"Token {config.proxy.token}"},
+            timeout=ClientTimeout(30),
         ) as resp:
-            if resp.ok:
-                webshare_response = resp.json()
-                return [
-                    f'http://{data["username"]}:{data["password"]}@{data["proxy_address"]}:{data["port"]}'
-                    for data in webshare_response["results"]
+            resp.raise_for_status()
+            return await resp.json()
+
+    def get_health(self, proxy, host):
+        if (proxy, host) not in self.health:
+            self.health[(proxy, host)] = ProxyHealth()
+
+        return self.health[(proxy, host)]
+
+    async def get_proxy(self, url=None):
+        host = urlsplit(url).hostname if url else None
+        proxies = self.proxies
+        now = monotonic()
+        weights = [self.get_health(proxy, host).weight(now) for proxy in proxies]
+        if not any(weights):
+            # Every proxy is quarantined for this host: fall back to the one
+            # whose cooldown ends first instead of stalling the crawl.
+            return min(
+                proxies,
+                key=lambda proxy: self.get_health(proxy, host).cooldown_until,
+            )
+
+        return choices(proxies, weights=weights)[0]
+
+    def report(self, proxy, url, latency, ok):
+        self.get_health(proxy, urlsplit(url).hostname).record(latency, ok)
+
+    def snapshot(self):
+        now, wall_now = monotonic(), time()
+        proxies = set(self.proxies)
+        return {
+            "proxies": self.proxies,
+            "health": [
+                [
+                    proxy,
+                    host,
+                    health.latency,
+                    health.success_rate,
+                    health.failures,
+                    wall_now + health.cooldown_until - now
+                    if health.cooldown_until > now
+                    else 0,
                 ]
+                for (proxy, host), health in self.health.items()
+                if proxy in proxies
+            ],
+        }
+
+    def restore(self, snapshot):
+        now, wall_now = monotonic(), time()
+        self.proxies = snapshot["proxies"]
+        for proxy, host, latency, success_rate, failures, cooldown in snapshot[
+            "health"
+        ]:
+            health = self.get_health(proxy, host)
+            health.latency = latency
+            health.success_rate = success_rate
+            health.failures = failures
+            if cooldown > wall_now:
+                health.cooldown_until = now + cooldown - wall_now
 
-    async def get_proxy(self):
-        return choice(self.proxies)
+        print(
+            f'{datetime.now().strftime("%d-%m-%Y %H:%M:%S")} - [ PROXIES ] {len(self.proxies)} restored from snapshot'
+        )
@@ -0,0 +1,229 @@
+import asyncio
+import sys
+from datetime import datetime
+
+from configs import config
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+# Every step is idempotent, so a database created from an up-to-date
+# script.sql and an old production database end up with the same schema.
+# Services apply pending migrations at startup, except ones with a step that
+# deletes rows: those only run from `python -m Database.migrations`.
+MIGRATIONS = (
+    (
+        1,
+        'cars unique key',
+        (
+            ('dedupe', 'cars', ('source_site_id', 'car_id')),
+            ('index', 'cars', 'uniq_car', ('source_site_id', 'car_id'), True),
+        ),
+    ),
+    (
+        2,
+        'cars last_seen_at',
+        (('column', 'cars', 'last_seen_at', 'timestamp NULL AFTER updated_at'),),
+    ),
+    (
+        3,
+        'cars deletion sweep index',
+        (
+            (
+                'index',
+                'cars',
+                'idx_cars_sweep',
+                ('source_site_id', 'body_id', 'deleted_at', 'last_seen_at'),
+                False,
+            ),
+        ),
+    ),
+    (
+        4,
+        'cars site filter indexes',
+        (
+            (
+                'index',
+                'cars',
+                'idx_cars_mark_model',
+                ('deleted_at', 'mark_id', 'model_id'),
+                False,
+            ),
+            ('index', 'cars', 'idx_cars_body', ('deleted_at', 'body_id'), False),
+            ('index', 'cars', 'idx_cars_price', ('deleted_at', 'price'), False),
+            ('index', 'cars', 'idx_cars_year', ('deleted_at', 'year'), False),
+        ),
+    ),
+    (
+        5,
+        'cars fingerprint',
+        (('column', 'cars', 'fingerprint', 'char(32) AFTER insurance_url'),),
+    ),
+)
+
+# Queries that run for every car or every body type. EXPLAIN must not plan
+# any of them as a full table scan.
+HOT_QUERIES = (
+    (
+        'upsert key lookup',
+        'SELECT id FROM cars WHERE source_site_id = 1 AND car_id = 1',
+    ),
+    (
+        'deletion sweep',
+        'UPDATE cars SET deleted_at = CURRENT_DATE '
+        'WHERE source_site_id = 1 AND body_id = 1 AND deleted_at IS NULL '
+        'AND (last_seen_at IS NULL OR last_seen_at < NOW())',
+    ),
+    (
+        'site filter by model',
+        'SELECT id FROM cars WHERE deleted_at IS NULL AND mark_id = 1 AND model_id = 1',
+    ),
+    (
+        'site filter by body',
+        'SELECT id FROM cars WHERE deleted_at IS NULL AND body_id = 1',
+    ),
+)
+
+
+class Migrations:
+    LOCK = 'parser_schema_migrations'
+    DESTRUCTIVE = ('dedupe',)
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    async def apply(self, destructive=True):
+        # Returns whether the schema is up to date afterwards.
+        async with self.engine.connect() as conn:
+            res = await conn.execute(
+                text('SELECT GET_LOCK(:name, 300)'), {'name': self.LOCK}
+            )
+            if not res.scalar():
+                print(f'{await self.time()} - [ MIGRATION ] Lock timeout')
+                return False
+
+            try:
+                await conn.execute(
+                    text(
+                        'CREATE TABLE IF NOT EXISTS schema_migrations ('
+                        'version smallint unsigned primary key, '
+                        'name varchar(100) not null, '
+                        'applied_at timestamp default now())'
+                    )
+                )
+                res = await conn.execute(text('SELECT version FROM schema_migrations'))
+                applied = set(res.scalars())
+                for version, name, steps in MIGRATIONS:
+                    if version in applied:
+                        continue
+
+                    if not destructive and any(
+                        step[0] in self.DESTRUCTIVE for step in steps
+                    ):
+                        print(
+                            f'{await self.time()} - [ MIGRATION ] {version} {name} deletes rows; run python -m Database.migrations'
+                        )
+                        return False
+
+                    for step in steps:
+                        await getattr(self, f'apply_{step[0]}')(conn, *step[1:])
+
+                    await conn.execute(
+                        text(
+                            'INSERT INTO schema_migrations (version, name) VALUES (:version, :name)'
+                        ),
+                        {'version': version, 'name': name},
+                    )
+                    await conn.commit()
+                    print(f'{await self.time()} - [ MIGRATION ] {version} {name}')
+
+                return True
+
+            finally:
+                await conn.execute(
+                    text('SELECT RELEASE_LOCK(:name)'), {'name': self.LOCK}
+                )
+                await conn.commit()
+
+    async def apply_dedupe(self, conn, table, columns):
+        # A unique key cannot be created over duplicates; keep the newest row.
+        # The car_options rows of the deleted ones go with them.
+        condition = ' AND '.join(f'a.{column} = b.{column}' for column in columns)
+        res = await conn.execute(
+            text(
+                f'DELETE a FROM {table} a JOIN {table} b ON {condition} AND a.id < b.id'
+            )
+        )
+        print(
+            f'{await self.time()} - [ MIGRATION ] Deleted {res.rowcount} duplicate rows from {table}, kept the highest id per ({", ".join(columns)})'
+        )
+
+    async def apply_index(self, conn, table, name, columns, unique):
+        res = await conn.execute(
+            text(
+                'SELECT COUNT(*) FROM information_schema.statistics '
+                'WHERE table_schema = DATABASE() AND table_name = :table AND index_name = :name'
+            ),
+            {'table': table, 'name': name},
+        )
+        if res.scalar():
+            return
+
+        await conn.execute(
+            text(
+                f'CREATE {"UNIQUE " if unique else ""}INDEX {name} ON {table} ({", ".join(columns)})'
+            )
+        )
+
+    async def apply_column(self, conn, table, name, definition):
+        res = await conn.execute(
+            text(
+                'SELECT COUNT(*) FROM information_schema.columns '
+                'WHERE table_schema = DATABASE() AND table_name = :table AND column_name = :name'
+            ),
+            {'table': table, 'name': name},
+        )
+        if res.scalar():
+            return
+
+        await conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {name} {definition}'))
+
+    async def check_plans(self):
+        failures = []
+        async with self.engine.connect() as conn:
+            for name, query in HOT_QUERIES:
+                res = await conn.execute(text(f'EXPLAIN {query}'))
+                for row in res.mappings():
+                    # Tiny tables are legitimately scanned; only fail where a
+                    # scan actually costs something.
+                    if (
+                        row['type'] == 'ALL'
+                        and (row['rows'] or 0) >= config.db.explain_min_rows
+                    ):
+                        failures.append(
+                            f'{name}: full scan of {row["table"]} ({row["rows"]} rows)'
+                        )
+
+        for failure in failures:
+            print(f'{await self.time()} - [ EXPLAIN ] {failure}')
+
+        return not failures
+
+    @staticmethod
+    async def time():
+        return datetime.now().strftime("%d-%m-%Y %H:%M:%S")
+
+
+async def main():
+    engine = create_async_engine(config.db.engine)
+    migrations = Migrations(engine)
+    try:
+        await migrations.apply()
+        ok = '--check' not in sys.argv or await migrations.check_plans()
+    finally:
+        await engine.dispose()
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
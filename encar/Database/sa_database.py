@@ -1,19 +1,77 @@
+import asyncio
+import hashlib
 from datetime import datetime
+from time import perf_counter
 
 from configs import config
+from Database.migrations import Migrations
 from Database.schema import (CarBody, CarFuelType, CarGearbox, CarMark,
                              CarModel, Cars, CarSourceSite, CarTransmission,
                              ParserMonitoring)
-from sqlalchemy import insert, select, update
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import insert, or_, select, update
+from sqlalchemy.dialects.mysql import insert as mysql_insert
 from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+DIMENSIONS = (
+    'car_sources',
+    'car_bodies',
+    'car_marks',
+    'car_models',
+    'car_transmissions',
+    'car_gearboxes',
+    'car_fuel_types',
+)
+DIMENSION_FIELDS = (
+    ('body_type', 'car_bodies', CarBody, 'kr_name'),
+    ('mark', 'car_marks', CarMark, 'kr_name'),
+    ('model', 'car_models', CarModel, 'kr_name'),
+    ('transmission', 'car_transmissions', CarTransmission, 'name'),
+    ('gearbox', 'car_gearboxes', CarGearbox, 'kr_name'),
+    ('fuel', 'car_fuel_types', CarFuelType, 'kr_name'),
+)
+FINGERPRINT_FIELDS = ('grade', 'year', 'price', 'mileage', 'engine', 'preview')
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    # Only checkouts that find every connection, overflow included, in use
+    # count as waits, so the numbers show whether the pool is too small
+    # rather than how long a connect takes.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def _do_get(self):
+        self.checkouts += 1
+        if self._max_overflow < 0 or (
+            self.checkedout() < self.size() + self._max_overflow
+        ):
+            return super()._do_get()
+
+        start = perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            wait = perf_counter() - start
+            self.waits += 1
+            self.wait_time += wait
+            self.max_wait = max(self.max_wait, wait)
 
 
 class Database:
     def __init__(self):
         self.engine = create_async_engine(
             config.db.engine,
-            echo=True,
+            echo=config.db.echo,
+            poolclass=TimedQueuePool,
+            pool_size=config.db.pool_size,
+            max_overflow=config.db.max_overflow,
+            pool_timeout=config.db.pool_timeout,
+            pool_pre_ping=config.db.pool_pre_ping,
+            pool_recycle=config.db.pool_recycle,
         )
         self.session = async_sessionmaker(bind=self.engine)
         self.car_sources = dict()
@@ -23,6 +81,59 @@ class Database:
         self.car_transmissions = dict()
         self.car_gearboxes = dict()
         self.car_fuel_types = dict()
+        self.preloading_task = None
+        self.run_started_at = datetime.now().replace(microsecond=0)
+        self.fingerprints = None
+
+    async def start(self, state=None):
+        try:
+            migrated = await Migrations(self.engine).apply(destructive=False)
+        except Exception as error:
+            print(f'{await self.time()} - [ MIGRATION ERROR ] {error}')
+            migrated = False
+
+        if not migrated:
+            # The queries assume the current schema, e.g. last_seen_at for
+            # the sweep; running against an older one is not safe.
+            await self.engine.dispose()
+            raise SystemExit(
+                f'{await self.time()} - [ MIGRATION ] Schema is not up to date, stopping'
+            )
+
+        if state and (snapshot := state.get('dimensions')):
+            # Start from the saved dictionaries; unseen values still go
+            # through resolve_dimensions, so a stale snapshot is harmless.
+            self.restore(snapshot)
+            self.preloading_task = asyncio.create_task(self.preloading())
+            return
+
+        await self.preloading()
+
+    async def stop(self):
+        if self.preloading_task:
+            await asyncio.gather(self.preloading_task, return_exceptions=True)
+
+        print(f'{await self.time()} - [ POOL ] {self.pool_statistics()}')
+        await self.engine.dispose()
+
+    def pool_statistics(self):
+        pool = self.engine.pool
+        return {
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow(),
+            'checkouts': pool.checkouts,
+            'waits': pool.waits,
+            'avg_wait': round(pool.wait_time / pool.waits, 4) if pool.waits else 0,
+            'max_wait': round(pool.max_wait, 4),
+        }
+
+    def snapshot(self):
+        return {name: getattr(self, name) for name in DIMENSIONS}
+
+    def restore(self, snapshot):
+        for name in DIMENSIONS:
+            getattr(self, name).update(snapshot.get(name, {}))
 
     async def update_monitoring(self, status):
         session = self.session()
@@ -60,145 +171,239 @@ class Database:
             await session.close()
             return
 
-    async def cars_processing(self, cars):
-        if not cars:
-            return
+    async def write_cars(self, cars):
+        if not self.car_sources:
+            await self.preloading()
 
-        await self.preloading()
-        await self.update_for_delete_flag(
-            cars[0].get('source'),
-            cars[0].get('body_type')
-        )
+        if self.fingerprints is None:
+            await self.load_fingerprints()
 
+        # Most listings are unchanged between runs; those only get their
+        # last_seen_at stamp refreshed instead of a full row rewrite.
+        unchanged, changed = [], []
         for car in cars:
-            await self.process_car(car)
+            if self.fingerprints.get(car.get('id')) == self.fingerprint(car):
+                unchanged.append(car.get('id'))
+            else:
+                changed.append(car)
 
-        await self.engine.dispose()
+        await self.resolve_dimensions(changed)
+        written = True
+        for offset in range(0, len(unchanged), config.db.chunk_size):
+            written &= await self.touch_cars(
+                unchanged[offset:offset + config.db.chunk_size]
+            )
+
+        for offset in range(0, len(changed), config.db.chunk_size):
+            written &= await self.upsert_cars(
+                changed[offset:offset + config.db.chunk_size]
+            )
+
+        return written
 
-    async def process_car(self, car):
+    async def load_fingerprints(self):
+        if not self.car_sources:
+            await self.preloading()
+
+        self.fingerprints = dict()
         session = self.session()
-        source_id = self.car_sources.get(car.get("source"))
-        res = await session.execute(
-            select(Cars.id)
-            .where(
-                Cars.source_site_id == source_id,
-                Cars.car_id == car.get('id')
+        try:
+            res = await session.execute(
+                select(Cars.car_id, Cars.fingerprint)
+                .where(Cars.source_site_id == self.car_sources.get(config.source))
             )
-        )
-        record_id = res.scalar_one_or_none()
-        if record_id:
-            try:
-                await session.execute(
-                    update(Cars)
-                    .where(Cars.id == record_id)
-                    .values(
-                        grade_name=car.get('grade'),
-                        year=car.get('year'),
-                        price=car.get('price'),
-                        mileage=car.get('mileage'),
-                        engine_vol=car.get('engine'),
-                        preview=car.get('preview'),
-                        deleted_at=None
-                    )
+            self.fingerprints.update(res.tuples())
+            await session.commit()
+            print(
+                f'{await self.time()} - [ FINGERPRINTS ] {len(self.fingerprints)} loaded'
+            )
+
+        except Exception as error:
+            await session.rollback()
+            print(f'{await self.time()} - [ ERROR ] {error}')
+
+        finally:
+            await session.close()
+
+    async def load_known_cars(self):
+        if not self.car_sources:
+            await self.preloading()
+
+        session = self.session()
+        try:
+            res = await session.execute(
+                select(Cars.car_id)
+                .where(
+                    Cars.source_site_id == self.car_sources.get(config.source),
+                    Cars.deleted_at.is_(None),
                 )
-                await session.commit()
+            )
+            known = set(res.scalars())
+            await session.commit()
+            print(f'{await self.time()} - [ KNOWN CARS ] {len(known)} loaded')
+            return known
 
-            except Exception as error:
-                await session.rollback()
-                print(f'{await self.time()} - [ ERROR ] {error}')
+        except Exception as error:
+            await session.rollback()
+            print(f'{await self.time()} - [ ERROR ] {error}')
 
-            finally:
-                await session.close()
-                return
+        finally:
+            await session.close()
 
-        body_id = await self.get_or_create_record(
-            target=car.get('body_type'),
-            dictionary=self.car_bodies,
-            table=CarBody,
-            field='kr_name',
-        )
-        mark_id = await self.get_or_create_record(
-            target=car.get('mark'),
-            dictionary=self.car_marks,
-            table=CarMark,
-            field='kr_name',
-        ),
-        model_id = await self.get_or_create_record(
-            target=car.get('model'),
-            dictionary=self.car_models,
-            table=CarModel,
-            field='kr_name',
-        )
-        transmission_id = await self.get_or_create_record(
-            target=car.get('transmission'),
-            dictionary=self.car_transmissions,
-            table=CarTransmission,
-            field='name',
-        )
-        gearbox_id = await self.get_or_create_record(
-            target=car.get('gearbox'),
-            dictionary=self.car_gearboxes,
-            table=CarGearbox,
-            field='kr_name'
-        )
-        fuel_type_id = await self.get_or_create_record(
-            target=car.get('fuel'),
-            dictionary=self.car_fuel_types,
-            table=CarFuelType,
-            field='kr_name'
-        )
+    @staticmethod
+    def fingerprint(car):
+        return hashlib.md5(
+            '\x1f'.join(str(car.get(field)) for field in FINGERPRINT_FIELDS)
+            .encode()
+        ).hexdigest()
+
+    async def mark_seen(self, car_ids):
+        seen = True
+        for offset in range(0, len(car_ids), config.db.chunk_size):
+            seen &= await self.touch_cars(
+                car_ids[offset:offset + config.db.chunk_size]
+            )
+
+        return seen
 
+    async def touch_cars(self, car_ids):
+        session = self.session()
         try:
             await session.execute(
-                insert(Cars)
+                update(Cars)
+                .where(
+                    Cars.source_site_id == self.car_sources.get(config.source),
+                    Cars.car_id.in_(car_ids),
+                )
                 .values(
-                    source_site_id=source_id,
-                    car_id=car.get('id'),
-                    body_id=body_id,
-                    mark_id=mark_id,
-                    model_id=model_id,
-                    grade_name=car.get('grade'),
-                    year=car.get('year'),
-                    price=car.get('price'),
-                    mileage=car.get('mileage'),
-                    gearbox_id=gearbox_id,
-                    transmission_id=transmission_id,
-                    fuel_type_id=fuel_type_id,
-                    engine_vol=car.get('engine'),
-                    preview=car.get('preview')
+                    last_seen_at=self.run_started_at,
+                    deleted_at=None,
+                    updated_at=Cars.updated_at,
                 )
             )
             await session.commit()
+            print(f'{await self.time()} - [ UNCHANGED ] {len(car_ids)} cars')
+            return True
 
         except Exception as error:
             await session.rollback()
             print(f'{await self.time()} - [ ERROR ] {error}')
+            return False
 
         finally:
             await session.close()
 
+    async def upsert_cars(self, cars):
+        rows = [self.build_row(car) for car in cars]
+        if await self.execute_upsert(rows):
+            self.fingerprints.update(
+                (row['car_id'], row['fingerprint']) for row in rows
+            )
+            print(f'{await self.time()} - [ UPSERT ] {len(rows)} cars')
+            return True
+
+        # Isolate the bad rows so one broken car does not drop its chunk.
+        written = len(rows) > 1
+        if written:
+            for row in rows:
+                if await self.execute_upsert([row]):
+                    self.fingerprints[row['car_id']] = row['fingerprint']
+                else:
+                    written = False
+
+        return written
+
+    async def execute_upsert(self, rows):
+        stmt = mysql_insert(Cars).values(rows)
+        stmt = stmt.on_duplicate_key_update(
+            grade_name=stmt.inserted.grade_name,
+            year=stmt.inserted.year,
+            price=stmt.inserted.price,
+            mileage=stmt.inserted.mileage,
+            engine_vol=stmt.inserted.engine_vol,
+            preview=stmt.inserted.preview,
+            fingerprint=stmt.inserted.fingerprint,
+            last_seen_at=stmt.inserted.last_seen_at,
+            updated_at=datetime.now(),
+            deleted_at=None,
+        )
+        session = self.session()
+        try:
+            await session.execute(stmt)
+            await session.commit()
+            return True
+
+        except Exception as error:
+            await session.rollback()
+            print(f'{await self.time()} - [ ERROR ] {error}')
+            return False
+
+        finally:
+            await session.close()
+
+    def build_row(self, car):
+        return dict(
+            source_site_id=self.car_sources.get(car.get('source')),
+            car_id=car.get('id'),
+            body_id=self.car_bodies.get(car.get('body_type')),
+            mark_id=self.car_marks.get(car.get('mark')),
+            model_id=self.car_models.get(car.get('model')),
+            grade_name=car.get('grade'),
+            year=car.get('year'),
+            price=car.get('price'),
+            mileage=car.get('mileage'),
+            gearbox_id=self.car_gearboxes.get(car.get('gearbox')),
+            transmission_id=self.car_transmissions.get(car.get('transmission')),
+            fuel_type_id=self.car_fuel_types.get(car.get('fuel')),
+            engine_vol=car.get('engine'),
+            preview=car.get('preview'),
+            fingerprint=self.fingerprint(car),
+            last_seen_at=self.run_started_at,
+        )
+
+    async def resolve_dimensions(self, cars):
+        for key, name, table, field in DIMENSION_FIELDS:
+            dictionary = getattr(self, name)
+            missing = {
+                car.get(key) for car in cars if car.get(key)
+            } - dictionary.keys()
+            if missing:
+                await self.create_records(table, field, missing, dictionary)
+
     async def get_or_create_record(self, target, dictionary, table, field):
         if not target:
             return None
 
-        while True:
-            target_id = dictionary.get(target)
-            if target_id:
-                return target_id
+        if target not in dictionary:
+            await self.create_records(table, field, {target}, dictionary)
 
-            await self.creating_record(table=table, val_dict={f'{field}': target})
-            await self.get_all_records(table=table, dictionary=dictionary)
+        return dictionary.get(target)
 
-    async def creating_record(self, table, val_dict):
+    async def create_records(self, table, field, values, dictionary):
+        column = getattr(table, field)
         session = self.session()
         try:
             await session.execute(
-                insert(table).values(val_dict).prefix_with('IGNORE')
+                insert(table)
+                .values([{field: value} for value in values])
+                .prefix_with('IGNORE')
             )
-            await session.commit()
+            res = await session.execute(
+                select(table.id, column).where(column.in_(list(values)))
+            )
+            # MySQL matches unique keys by collation, so the stored spelling
+            # may differ from ours in case or trailing spaces.
+            stored = {
+                str(value).rstrip().lower(): record_id for record_id, value in res
+            }
+            for value in values:
+                if record_id := stored.get(value.rstrip().lower()):
+                    dictionary[value] = record_id
 
-        except IntegrityError as error:
-            print(f'{await self.time()} - [ ERROR ] {error}')
+            await session.commit()
+            print(
+                f'{await self.time()} - [ DIMENSION ] {table.__tablename__}: {len(values)} resolved'
+            )
 
         except Exception as error:
             await session.rollback()
@@ -207,7 +412,7 @@ class Database:
         finally:
             await session.close()
 
-    async def update_for_delete_flag(self, source, body_type):
+    async def sweep_deleted(self, source, body_type):
         source_id = self.car_sources.get(source)
         body_id = await self.get_or_create_record(
             target=body_type,
@@ -217,17 +422,22 @@ class Database:
         )
         session = self.session()
         try:
-            await session.execute(
+            res = await session.execute(
                 update(Cars)
                 .where(
                     Cars.source_site_id == source_id,
-                    Cars.body_id == body_id
+                    Cars.body_id == body_id,
+                    Cars.deleted_at.is_(None),
+                    or_(
+                        Cars.last_seen_at.is_(None),
+                        Cars.last_seen_at < self.run_started_at,
+                    ),
                 )
                 .values(deleted_at=datetime.now().date())
             )
             await session.commit()
             print(
-                f'{await self.time()} - [ UPDATING ] The date is set for the deleted_at field for the body {body_type}.'
+                f'{await self.time()} - [ SWEEP ] {res.rowcount} cars not seen in this run are marked deleted for the body {body_type}.'
             )
 
         except Exception as error:
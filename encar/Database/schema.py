@@ -116,6 +116,8 @@ class Cars(Base):
     seller = Column(JSON)
     tech_inspection_url = Column(JSON)
     insurance_url = Column(JSON)
+    fingerprint = Column(String)
     created_at = Column(DateTime, default=datetime.now())
     updated_at = Column(DateTime, default=datetime.now(), onupdate=datetime.now())
+    last_seen_at = Column(DateTime)
     deleted_at = Column(DateTime)
@@ -3,8 +3,10 @@ import re
 from datetime import datetime
 from math import ceil
 from pathlib import Path
+from time import time
 
-import aiofiles
+from configs import config
+from Utils.worker_pool import WorkerPool
 
 ROOT_DIR = Path("share")
 ROOT_DIR.mkdir(exist_ok=True)
@@ -12,6 +14,12 @@ ROOT_DIR.mkdir(exist_ok=True)
 
 class EncarParser:
     LIMIT = 299
+    # Facets used to partition oversized categories, with the value range
+    # each one covers. Price is in 10k won, Year is YYYYMM.
+    FACETS = (
+        ("Price", 0, 100_000),
+        ("Year", 190_000, 210_000),
+    )
     PARAMS = {
         "http://api.encar.com/search/car/list/premium": {
             "expession": "(And.Hidden.N._.{type}._.{body})",
@@ -50,145 +58,451 @@ class EncarParser:
         },
     }
 
-    def __init__(self, request_dispatcher, database):
+    def __init__(self, request_dispatcher, database, writer, state, photo_store):
         self.request_dispatcher = request_dispatcher
+        self.photo_store = photo_store
         self.database = database
+        self.writer = writer
+        self.state = state
 
     async def parse(self):
-        for base_url, param in self.PARAMS.items():
-            for type_ in param["types"]:
-                for body_ in param["body_type"]:
-                    count_url = f'{base_url}?count=true&q={param["expession"].format(type=type_, body=body_)}'
-                    async with self.request_dispatcher.get(count_url) as resp:
-                        if resp.ok:
-                            res = await resp.json()
-                            _, pages = await self.get_total_records_and_pages(
-                                res["Count"]
-                            )
-
-                    offset = 0
-                    tasks = []
-                    result = []
-                    for page in range(1, pages + 1):
-                        if page != 1:
-                            offset += self.LIMIT
-
-                        data_url = f"{count_url}&sr=|ModifiedDate|{offset}|{self.LIMIT}"
-                        if len(tasks) == 30:
-                            result += await asyncio.gather(*tasks)
-                            tasks.clear()
-
-                        tasks.append(
-                            asyncio.create_task(self.get_cars(data_url, body_))
-                        )
-
-                    result += await asyncio.gather(*tasks)
-                    tasks.clear()
-
-                    result = {car["id"]: car for batch in result for car in batch}
-
-                    for car in result.values():
-                        if len(tasks) == 30:
-                            await asyncio.gather(*tasks)
-                            tasks.clear()
-
-                        tasks.append(asyncio.create_task(self.download_photo(car)))
-
-                    await asyncio.gather(*tasks)
-                    tasks.clear()
-
-                    await self.database.cars_processing(cars=list(result.values()))
+        # One budget shared by every category, so the small categories fill
+        # the slots the big ones leave idle instead of waiting their turn.
+        self.budget = asyncio.Semaphore(config.workers.size)
+        self.watermarks = self.state.get("encar_watermarks", {})
+        self.snapshots = self.state.get("encar_snapshots", {})
+        self.keyset = config.encar.keyset
+        self.full_pass = (
+            not config.encar.incremental
+            or not self.watermarks
+            or time() - self.state.get("encar_full_pass_at", 0)
+            >= config.encar.full_pass_interval
+        )
+        print(
+            f'{await self.time()} - [ MODE ] {"full" if self.full_pass else "incremental"}'
+        )
+        categories = [
+            {
+                "base_url": base_url,
+                "expression": param["expession"].format(type=type_, body=body_),
+                "body": body_,
+                "filters": (),
+                "pages": None,
+            }
+            for base_url, param in self.PARAMS.items()
+            for body_ in param["body_type"]
+            for type_ in param["types"]
+        ]
+        async with WorkerPool(semaphore=self.budget) as pool:
+            for category in categories:
+                await pool.submit(self.count_category(category))
+
+        # CarType.N and CarType.Y share body types, so a body type is swept
+        # only after all of its categories are written. Categories whose
+        # count failed keep pages None and block the sweep of their body.
+        body_types = {}
+        for category in categories:
+            body_types.setdefault(category["body"], []).append(category)
+
+        await asyncio.gather(
+            *(
+                self.parse_body_type(body_, categories)
+                for body_, categories in body_types.items()
+            )
+        )
 
-    async def download_photo(self, car):
-        car_dir = ROOT_DIR.joinpath(f'encar_{car["id"]}')
-        car_dir.mkdir(parents=True, exist_ok=True)
-        attempts = 2
+        self.state.set("encar_watermarks", self.watermarks)
+        self.state.set("encar_snapshots", self.snapshots)
+        if self.full_pass:
+            self.state.set("encar_full_pass_at", time())
+
+    async def count_category(self, category):
+        category["pages"] = None
+        async with self.request_dispatcher.get(self.category_url(category)) as resp:
+            if resp is not None and resp.ok:
+                res = await resp.json()
+                category["count"], category["pages"] = (
+                    await self.get_total_records_and_pages(res["Count"])
+                )
+
+        return category
+
+    async def count_partition(self, category):
+        async with self.budget:
+            return await self.count_category(category)
+
+    def category_url(self, category):
+        expression = category["expression"]
+        for facet, lo, hi in category["filters"]:
+            name, facet_lo, facet_hi = self.FACETS[facet]
+            lower = "" if lo == facet_lo else lo
+            upper = "" if hi == facet_hi else hi
+            expression = f"{expression[:-1]}_.{name}.range({lower}..{upper}).)"
+
+        if upper := category.get("modified_before"):
+            expression = f'{expression[:-1]}_.ModifiedDate.range(..{re.sub(r"[^0-9]", "", upper)}).)'
+
+        return f'{category["base_url"]}?count=true&q={expression}'
+
+    async def split_category(self, category):
+        # Deep offsets get slower and less reliable, so an oversized result
+        # set is cut into facet ranges until every partition fits in a few
+        # pages. Partitions are crawled in parallel and merged by Id.
+        if not category["pages"] or category["pages"] <= config.encar.max_pages:
+            return [category]
+
+        partitions = self.split_filters(category["filters"])
+        if partitions is None:
+            return [category]
+
+        children = await asyncio.gather(
+            *(
+                self.count_partition({**category, "filters": filters})
+                for filters in partitions
+            )
+        )
+        nested = await asyncio.gather(
+            *(self.split_category(child) for child in children)
+        )
+        return [partition for group in nested for partition in group]
+
+    def split_filters(self, filters):
+        if filters and filters[-1][2] > filters[-1][1]:
+            base, (facet, lo, hi) = filters[:-1], filters[-1]
+        else:
+            base, facet = filters, filters[-1][0] + 1 if filters else 0
+            if facet == len(self.FACETS):
+                return None
+
+            _, lo, hi = self.FACETS[facet]
+
+        middle = (lo + hi) // 2
+        return [base + ((facet, lo, middle),), base + ((facet, middle + 1, hi),)]
+
+    async def parse_body_type(self, body_, categories):
+        # Cars stream from the page requests through a bounded queue into
+        # the photo downloads and on to the write-behind queue, so a body
+        # type never holds more than the queue size in memory.
+        queue = asyncio.Queue(maxsize=config.encar.queue_size)
+        consumer = asyncio.create_task(self.store_cars(queue))
+        seen = set()
+        try:
+            crawls = await asyncio.gather(
+                *(self.crawl_category(category, queue, seen) for category in categories)
+            )
+        except BaseException:
+            consumer.cancel()
+            await asyncio.gather(consumer, return_exceptions=True)
+            raise
+
+        await queue.put(None)
+        await consumer
+
+        complete = True
+        for category, (newest, crawled) in zip(categories, crawls):
+            complete &= crawled
+            if crawled and newest:
+                self.update_watermark(category, newest)
+
+        if not self.full_pass:
+            # An incremental pass never sees the unchanged tail of a
+            # category, so deletions are left to the next full pass.
+            return
+
+        if not complete:
+            print(
+                f'{await self.time()} - [ SWEEP ] Skipped for the body {body_}: some requests failed.'
+            )
+            return
+
+        await self.writer.finish_body_type(
+            "encar", re.search(r"\.(?P<type>.+)\.", body_).group("type")
+        )
+
+    async def store_cars(self, queue):
+        async with WorkerPool(semaphore=self.budget) as pool:
+            while (car := await queue.get()) is not None:
+                await pool.submit(self.store_car(car))
+
+    async def crawl_category(self, category, queue, seen):
+        if category["pages"] is None:
+            return "", False
+
+        if not category["pages"]:
+            return "", True
+
+        async with self.budget:
+            first_page = await self.get_page(
+                f"{self.category_url(category)}&sr=|ModifiedDate|0|{self.LIMIT}"
+            )
+
+        if first_page is None:
+            return "", False
+
+        # Same count, same newest listing and same first page as last run:
+        # nothing was added, edited or sold, so only refresh last_seen_at.
+        # A full pass only trusts snapshots of full crawls: an incremental
+        # one keeps ids it could not check, including cars sold since.
+        head = {
+            "count": category["count"],
+            "top": self.modified_at(first_page[0].get("ModifiedDate"))
+            if first_page
+            else "",
+            "head": sorted(int(car["Id"]) for car in first_page),
+        }
+        snapshot = self.snapshots.get(category["expression"], {})
+        if (
+            snapshot.get("ids")
+            and (snapshot.get("full") or not self.full_pass)
+            and all(snapshot.get(key) == value for key, value in head.items())
+        ):
+            print(
+                f'{await self.time()} - [ UNCHANGED ] {category["expression"]} - {len(snapshot["ids"])} cars'
+            )
+            return "", await self.database.mark_seen(snapshot["ids"])
+
+        ids, newest, complete = set(), "", True
+        async for cars in self.crawl_pages(category):
+            if cars is None:
+                complete = False
+                continue
+
+            for car in cars:
+                ids.add(car["id"])
+                newest = max(newest, self.modified_at(car.get("modified_at")))
+                if car["id"] in seen:
+                    continue
+
+                seen.add(car["id"])
+                await queue.put(car)
+
+        if complete:
+            if not self.full_pass:
+                ids.update(snapshot.get("ids", []))
+
+            self.snapshots[category["expression"]] = {
+                **head,
+                "ids": sorted(ids),
+                "full": self.full_pass,
+            }
+
+        return newest, complete
+
+    async def crawl_pages(self, category):
+        # Yields the cars of every page as soon as it arrives; a page that
+        # could not be fetched yields None.
+        watermark = self.watermarks.get(category["expression"])
+        if not self.full_pass and watermark:
+            async for cars in self.walk_category(category, watermark):
+                yield cars
+
+            return
+
+        partitions = await self.split_category(category)
+        print(
+            f'{await self.time()} - [ PARTITIONS ] {category["expression"]} - {len(partitions)}'
+        )
+        if any(partition["pages"] is None for partition in partitions):
+            yield None
+
+        elif (
+            found := sum(partition["count"] for partition in partitions)
+        ) < category["count"]:
+            # The partitions miss listings the category holds, e.g. when a
+            # range bound is not inclusive; the sweep would delete them.
+            print(
+                f'{await self.time()} - [ PARTITIONS ] {category["expression"]} - {found} of {category["count"]} cars covered'
+            )
+            yield None
+
+        async for cars in self.merge(
+            [
+                self.parse_category(partition)
+                for partition in partitions
+                if partition["pages"]
+            ]
+        ):
+            yield cars
+
+    async def walk_category(self, category, watermark=""):
+        # Pages through a category newest first. With keyset paging every
+        # request asks for the next window below the last ModifiedDate seen,
+        # skipping only the listings that share that exact timestamp, so the
+        # cost per page stays flat however deep the walk goes.
+        upper, ties, offset, pages, total = None, 0, 0, 0, 0
         while True:
+            if self.keyset and upper:
+                url = self.category_url({**category, "modified_before": upper})
+                data_url = f"{url}&sr=|ModifiedDate|{ties}|{self.LIMIT}"
+            else:
+                url = self.category_url(category)
+                data_url = f"{url}&sr=|ModifiedDate|{offset}|{self.LIMIT}"
+
+            async with self.budget:
+                results = await self.get_page(data_url)
+
+            if self.keyset and upper and (
+                results is None
+                or any(
+                    self.modified_at(car.get("ModifiedDate")) > upper
+                    for car in results
+                )
+            ):
+                # The API rejected or ignored the ModifiedDate window: page by
+                # offset from here on.
+                print(
+                    f'{await self.time()} - [ KEYSET ] Not supported, falling back to offsets'
+                )
+                self.keyset = False
+                continue
+
+            if results is None:
+                yield None
+                return
+
+            pages += 1
+            offset += len(results)
+            cars = await self.extract_cars(results, category["body"])
+            total += len(cars)
+            yield cars
+            if len(results) < self.LIMIT:
+                break
+
+            oldest = self.modified_at(results[-1].get("ModifiedDate"))
+            if watermark and oldest < watermark:
+                break
+
+            ties = (ties if oldest == upper else 0) + sum(
+                self.modified_at(car.get("ModifiedDate")) == oldest
+                for car in results
+            )
+            upper = oldest
+
+        print(
+            f'{await self.time()} - [ WALK ] {category["expression"]} - {pages} pages, {total} cars'
+        )
+
+    def update_watermark(self, category, newest):
+        if newest > self.watermarks.get(category["expression"], ""):
+            self.watermarks[category["expression"]] = newest
+
+    @staticmethod
+    def modified_at(value):
+        return str(value or "")[:19]
+
+    async def parse_category(self, category):
+        if category["pages"] > config.encar.max_pages:
+            # Only partitions that could not be split further get here;
+            # walk them instead of requesting deep offsets in parallel.
+            async for cars in self.walk_category(category):
+                yield cars
+
+            return
+
+        url = self.category_url(category)
+        async for cars in self.merge(
+            [
+                self.fetch_cars(
+                    f"{url}&sr=|ModifiedDate|{page * self.LIMIT}|{self.LIMIT}",
+                    category["body"],
+                )
+                for page in range(category["pages"])
+            ]
+        ):
+            yield cars
+
+    async def fetch_cars(self, url, body_type):
+        async with self.budget:
+            cars = await self.get_cars(url, body_type)
+
+        yield cars
+
+    async def merge(self, streams):
+        # Interleaves page streams in arrival order. The queue holds at most
+        # one page per stream, so a fast stream waits for the consumer
+        # instead of buffering pages.
+        queue = asyncio.Queue(maxsize=len(streams) or 1)
+        done = object()
+
+        async def pump(stream):
             try:
-                async with self.request_dispatcher.get(
-                    url=car["preview"],
-                    params={
-                        "impolicy": "widthRate",
-                        "rw": 1024,
-                        "cw": 1024,
-                        "ch": 768,
-                    },
-                ) as resp:
-                    if resp.ok:
-                        path_to_photo = car_dir.joinpath(Path(car["preview"]).name)
-                        async with aiofiles.open(path_to_photo, "wb") as f:
-                            await f.write(await resp.read())
-
-                        car["preview"] = str(path_to_photo)
-                        return
+                async for cars in stream:
+                    await queue.put(cars)
 
             except Exception as error:
-                print(
-                    f'{await self.time()} - [ ERROR ] {error}'
-                )
-                if attempts == 0:
-                    break
+                print(f'{await self.time()} - [ ERROR ] {error}')
+                await queue.put(None)
+
+            await queue.put(done)
 
-                await asyncio.sleep(2)
-                attempts -= 1
+        tasks = [asyncio.create_task(pump(stream)) for stream in streams]
+        try:
+            remaining = len(tasks)
+            while remaining:
+                cars = await queue.get()
+                if cars is done:
+                    remaining -= 1
+                    continue
+
+                yield cars
+
+        finally:
+            for task in tasks:
+                task.cancel()
+
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def store_car(self, car):
+        await self.download_photo(car)
+        await self.writer.put(car)
+
+    async def download_photo(self, car):
+        if path_to_photo := await self.photo_store.get(
+            car["preview"],
+            ROOT_DIR.joinpath(f'encar_{car["id"]}', Path(car["preview"]).name),
+            params={
+                "impolicy": "widthRate",
+                "rw": 1024,
+                "cw": 1024,
+                "ch": 768,
+            },
+        ):
+            car["preview"] = path_to_photo
 
     async def get_cars(self, url, body_type):
+        results = await self.get_page(url)
+        if results is not None:
+            return await self.extract_cars(results, body_type)
+
+    async def get_page(self, url):
         async with self.request_dispatcher.get(url) as resp:
-            if resp.ok:
+            if resp is not None and resp.ok:
                 res = await resp.json()
-                result = []
-                for car in res["SearchResults"]:
-                    if not car.get("Photos"):
-                        continue
-
-                    if car.get("Lease"):
-                        continue
-
-                    if car.get("ServiceCopyCar"):
-                        if car.get("ServiceCopyCar") == "ORIGINAL":
-                            result.append(
-                                {
-                                    "source": "encar",
-                                    "id": int(car["Id"]),
-                                    "preview": await self.extract_preview(
-                                        car.get("Photos")
-                                    ),
-                                    "body_type": re.search(
-                                        r"\.(?P<type>.+)\.", body_type
-                                    ).group("type"),
-                                    "mark": car["Manufacturer"],
-                                    "model": car["Model"],
-                                    "grade": await self.extract_grade(car),
-                                    "gearbox": car.get("Transmission"),
-                                    "transmission": await self.extract_transmission(
-                                        car.get("Badge")
-                                    ),
-                                    "engine": await self.extract_engine_volume(
-                                        car.get("Badge")
-                                    ),
-                                    "year": int(car["FormYear"])
-                                    if car.get("FormYear")
-                                    else None,
-                                    "fuel": car["FuelType"],
-                                    "mileage": int(car["Mileage"]),
-                                    "price": int(car["Price"] * 10_000),
-                                }
-                            )
-
-                        else:
-                            continue
+                return res["SearchResults"]
+
+    async def extract_cars(self, results, body_type):
+        result = []
+        for car in results:
+            if not car.get("Photos"):
+                continue
 
+            if car.get("Lease"):
+                continue
+
+            if car.get("ServiceCopyCar"):
+                if car.get("ServiceCopyCar") == "ORIGINAL":
                     result.append(
                         {
                             "source": "encar",
                             "id": int(car["Id"]),
-                            "preview": await self.extract_preview(car.get("Photos")),
+                            "preview": await self.extract_preview(
+                                car.get("Photos")
+                            ),
                             "body_type": re.search(
                                 r"\.(?P<type>.+)\.", body_type
                             ).group("type"),
                             "mark": car["Manufacturer"],
                             "model": car["Model"],
-                            # 'grade': f'{car.get("FormDetail")} {car.get("Capacity")} {car.get("Badge")}'.strip(),
                             "grade": await self.extract_grade(car),
                             "gearbox": car.get("Transmission"),
                             "transmission": await self.extract_transmission(
@@ -203,10 +517,43 @@ class EncarParser:
                             "fuel": car["FuelType"],
                             "mileage": int(car["Mileage"]),
                             "price": int(car["Price"] * 10_000),
+                            "modified_at": car.get("ModifiedDate"),
                         }
                     )
 
-                return result
+                else:
+                    continue
+
+            result.append(
+                {
+                    "source": "encar",
+                    "id": int(car["Id"]),
+                    "preview": await self.extract_preview(car.get("Photos")),
+                    "body_type": re.search(
+                        r"\.(?P<type>.+)\.", body_type
+                    ).group("type"),
+                    "mark": car["Manufacturer"],
+                    "model": car["Model"],
+                    # 'grade': f'{car.get("FormDetail")} {car.get("Capacity")} {car.get("Badge")}'.strip(),
+                    "grade": await self.extract_grade(car),
+                    "gearbox": car.get("Transmission"),
+                    "transmission": await self.extract_transmission(
+                        car.get("Badge")
+                    ),
+                    "engine": await self.extract_engine_volume(
+                        car.get("Badge")
+                    ),
+                    "year": int(car["FormYear"])
+                    if car.get("FormYear")
+                    else None,
+                    "fuel": car["FuelType"],
+                    "mileage": int(car["Mileage"]),
+                    "price": int(car["Price"] * 10_000),
+                    "modified_at": car.get("ModifiedDate"),
+                }
+            )
+
+        return result
 
     async def get_total_records_and_pages(self, total):
         print(
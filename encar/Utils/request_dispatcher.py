@@ -1,9 +1,14 @@
 import asyncio
 from datetime import datetime
-from random import randint
+from random import uniform
+from time import monotonic
 
 from aiohttp import ClientSession, ClientTimeout
 from fake_useragent import FakeUserAgent
+from Utils.limiter import HostLimiter
+
+BACKOFF_STATUSES = (429, 500, 502, 503, 504)
+PROXY_FAILURE_STATUSES = (403, 407, 429)
 
 
 class _SafeRequestContextManager:
@@ -11,12 +16,14 @@ class _SafeRequestContextManager:
         self,
         session,
         proxy_dispatcher,
+        limiter,
         method,
         url,
         **kwargs,
     ):
         self.session = session
         self.proxy_dispatcher = proxy_dispatcher
+        self.limiter = limiter
         self.url = url
         self.method = method
         self.kwargs = kwargs
@@ -32,18 +39,40 @@ class _SafeRequestContextManager:
                 self.kwargs["headers"] = {"User-Agent": self.agent.random}
 
             try:
-                proxy = await self.proxy_dispatcher.get_proxy()
+                proxy = await self.proxy_dispatcher.get_proxy(self.url)
                 print(
                     f'{datetime.now().strftime("%d-%m-%Y %H:%M:%S")} - [ URL ] {self.url} - [ {proxy} ]'
                 )
-                await asyncio.sleep(randint(1, 2))
-                result = await self.session.request(
-                    self.method,
+                await self.limiter.acquire()
+                start = monotonic()
+                try:
+                    result = await self.session.request(
+                        self.method,
+                        self.url,
+                        proxy=proxy,
+                        verify_ssl=False,
+                        timeout=self.timeout,
+                        **self.kwargs,
+                    )
+                except asyncio.TimeoutError:
+                    self.limiter.release(healthy=False)
+                    self.proxy_dispatcher.report(proxy, self.url, None, False)
+                    raise
+                except Exception:
+                    self.limiter.release()
+                    self.proxy_dispatcher.report(proxy, self.url, None, False)
+                    raise
+                except BaseException:
+                    self.limiter.release()
+                    raise
+
+                self.res = result
+                self.latency = monotonic() - start
+                self.proxy_dispatcher.report(
+                    proxy,
                     self.url,
-                    proxy=proxy,
-                    verify_ssl=False,
-                    timeout=self.timeout,
-                    **self.kwargs,
+                    self.latency,
+                    result.status not in PROXY_FAILURE_STATUSES,
                 )
                 return result
 
@@ -58,22 +87,31 @@ class _SafeRequestContextManager:
                     f'{datetime.now().strftime("%d-%m-%Y %H:%M:%S")} - [ ATTEMPT ] {attempt} - [ ERROR ] {error} - [ URL ] {self.url}'
                 )
                 attempt += 1
-                await asyncio.sleep(randint(2, 3))
+                # The failed proxy is already down-weighted, so the next
+                # attempt only needs a short jitter rather than a full pause.
+                await asyncio.sleep(uniform(0.5, 1))
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         if hasattr(self, "res"):
             self.res.close()
+            self.limiter.release(
+                latency=self.latency,
+                healthy=self.res.status not in BACKOFF_STATUSES
+                and not isinstance(exc_val, asyncio.TimeoutError),
+            )
 
 
 class RequestDispatcher:
     def __init__(self, session, proxy_dispatcher):
         self.session = session
         self.proxy_dispatcher = proxy_dispatcher
+        self.limiter = HostLimiter()
 
     def request(self, method, url, **kwargs):
         return _SafeRequestContextManager(
             self.session,
             self.proxy_dispatcher,
+            self.limiter.get(url),
             method,
             url,
             **kwargs,
@@ -0,0 +1,63 @@
+import asyncio
+from datetime import datetime
+
+
+class WorkerPool:
+    def __init__(self, size=None, semaphore=None):
+        # Pools that share one semaphore share one concurrency budget while
+        # still collecting their own results and errors.
+        self.semaphore = semaphore or asyncio.Semaphore(size)
+        self.tasks = set()
+        self.results = []
+        self.errors = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            await self.cancel()
+            return
+
+        await self.join()
+
+    async def submit(self, coro):
+        try:
+            await self.semaphore.acquire()
+        except BaseException:
+            coro.close()
+            raise
+
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.done)
+        return task
+
+    def done(self, task):
+        self.tasks.discard(task)
+        self.semaphore.release()
+        if task.cancelled():
+            return
+
+        if error := task.exception():
+            self.errors.append(error)
+            print(
+                f'{datetime.now().strftime("%d-%m-%Y %H:%M:%S")} - [ WORKER ERROR ] {error!r}'
+            )
+            return
+
+        self.results.append(task.result())
+
+    async def join(self):
+        try:
+            while self.tasks:
+                await asyncio.wait(set(self.tasks))
+        except asyncio.CancelledError:
+            await self.cancel()
+            raise
+
+    async def cancel(self):
+        for task in self.tasks:
+            task.cancel()
+
+        await asyncio.gather(*self.tasks, return_exceptions=True)
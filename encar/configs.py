@@ -2,10 +2,48 @@ import os
 
 
 class Proxy:
-    url = (
-        "https://proxy.webshare.io/api/v2/proxy/list/?mode=direct&page=1&page_size=100"
+    url = os.getenv(
+        'PROXY_URL', "https://proxy.webshare.io/api/v2/proxy/list/"
     )
     token = os.getenv('PROXY_TOKEN')
+    page_size = int(os.getenv('PROXY_PAGE_SIZE', 100))
+    refresh_interval = int(os.getenv('PROXY_REFRESH_INTERVAL', 900))
+    default_latency = float(os.getenv('PROXY_DEFAULT_LATENCY', 2))
+    min_success_rate = float(os.getenv('PROXY_MIN_SUCCESS_RATE', 0.05))
+    ewma_alpha = float(os.getenv('PROXY_EWMA_ALPHA', 0.3))
+    quarantine_after = int(os.getenv('PROXY_QUARANTINE_AFTER', 3))
+    cooldown = float(os.getenv('PROXY_COOLDOWN', 60))
+    max_cooldown = float(os.getenv('PROXY_MAX_COOLDOWN', 1800))
+
+
+class Limiter:
+    initial = int(os.getenv('LIMITER_INITIAL', 8))
+    minimum = int(os.getenv('LIMITER_MIN', 2))
+    maximum = int(os.getenv('LIMITER_MAX', 64))
+    increase = float(os.getenv('LIMITER_INCREASE', 1))
+    decrease = float(os.getenv('LIMITER_DECREASE', 0.5))
+    latency_target = float(os.getenv('LIMITER_LATENCY_TARGET', 5))
+
+
+class Workers:
+    size = int(os.getenv('WORKER_POOL_SIZE', 30))
+
+
+class State:
+    path = os.getenv('STATE_DIR', 'state')
+    max_age = int(os.getenv('STATE_MAX_AGE', 7 * 24 * 3600))
+
+
+class Encar:
+    max_pages = int(os.getenv('ENCAR_MAX_PAGES', 5))
+    incremental = os.getenv('ENCAR_INCREMENTAL', '1') == '1'
+    keyset = os.getenv('ENCAR_KEYSET', '1') == '1'
+    full_pass_interval = int(os.getenv('ENCAR_FULL_PASS_INTERVAL', 24 * 3600))
+    queue_size = int(os.getenv('ENCAR_QUEUE_SIZE', 600))
+
+
+class Photos:
+    max_age = int(os.getenv('PHOTO_INDEX_MAX_AGE', 30 * 24 * 3600))
 
 
 class MySQLConnection:
@@ -15,11 +53,26 @@ class MySQLConnection:
     user = os.getenv('DB_USER')
     password = os.getenv('DB_PSWD')
     engine = f"mysql+aiomysql://{user}:{password}@{host}:{port}/{database}"
+    chunk_size = int(os.getenv('DB_CHUNK_SIZE', 500))
+    queue_size = int(os.getenv('DB_QUEUE_SIZE', 2000))
+    flush_interval = float(os.getenv('DB_FLUSH_INTERVAL', 5))
+    explain_min_rows = int(os.getenv('DB_EXPLAIN_MIN_ROWS', 1000))
+    pool_size = int(os.getenv('DB_POOL_SIZE', 5))
+    max_overflow = int(os.getenv('DB_MAX_OVERFLOW', 10))
+    pool_timeout = int(os.getenv('DB_POOL_TIMEOUT', 30))
+    pool_pre_ping = os.getenv('DB_POOL_PRE_PING', '1') == '1'
+    pool_recycle = int(os.getenv('DB_POOL_RECYCLE', 3600))
+    echo = os.getenv('LOG_LEVEL', 'INFO').upper() == 'DEBUG'
 
 
 class Configuration:
     source = "encar"
     proxy = Proxy()
+    limiter = Limiter()
+    workers = Workers()
+    state = State()
+    photos = Photos()
+    encar = Encar()
     db = MySQLConnection()
 
 
@@ -0,0 +1,121 @@
+import asyncio
+from datetime import datetime
+from time import monotonic
+
+from configs import config
+
+
+class WriteBehindQueue:
+    def __init__(self, database):
+        self.database = database
+        self.queue = asyncio.Queue(maxsize=config.db.queue_size)
+        self.consumer = None
+        self.batch = []
+        self.received = dict()
+        self.failed = set()
+
+    async def start(self):
+        self.consumer = asyncio.create_task(self.consume())
+
+    async def stop(self):
+        if self.consumer is None:
+            return
+
+        if not self.consumer.done():
+            await self.queue.put(None)
+
+        await asyncio.gather(self.consumer, return_exceptions=True)
+
+    async def put(self, car):
+        # Blocks while the queue is full, which slows the crawl down to the
+        # pace MySQL can keep up with.
+        await self.queue.put(car)
+
+    async def seen(self, source, body_type, car_ids):
+        # Cars skipped as unchanged count towards the body type like written
+        # ones, so the sweep still runs and still keeps them.
+        key = (source, body_type)
+        self.received[key] = self.received.get(key, 0) + len(car_ids)
+        if not await self.database.mark_seen(car_ids):
+            self.failed.add(key)
+
+    async def finish_body_type(self, source, body_type):
+        await self.queue.put((source, body_type))
+
+    async def consume(self):
+        deadline = None
+        while True:
+            if not self.batch:
+                deadline = None
+            elif deadline is None:
+                deadline = monotonic() + config.db.flush_interval
+
+            try:
+                item = await asyncio.wait_for(
+                    self.queue.get(),
+                    None if deadline is None else max(deadline - monotonic(), 0),
+                )
+            except asyncio.TimeoutError:
+                # Producers are slower than MySQL right now; write what has
+                # gathered in flush_interval instead of waiting for a full
+                # batch.
+                await self.flush()
+                continue
+
+            if item is None:
+                await self.flush()
+                return
+
+            if isinstance(item, tuple):
+                # Everything queued before the marker belongs to this body
+                # type, so it is flushed before the sweep runs.
+                await self.flush()
+                await self.sweep(*item)
+                continue
+
+            key = (item.get('source'), item.get('body_type'))
+            self.received[key] = self.received.get(key, 0) + 1
+            self.batch.append(item)
+            if len(self.batch) >= config.db.chunk_size:
+                await self.flush()
+
+    async def flush(self):
+        if not self.batch:
+            return
+
+        batch, self.batch = self.batch, []
+        try:
+            written = await self.database.write_cars(batch)
+        except Exception as error:
+            print(
+                f'{datetime.now().strftime("%d-%m-%Y %H:%M:%S")} - [ WRITE ERROR ] {error}'
+            )
+            written = False
+
+        if not written:
+            self.failed.update(
+                (car.get('source'), car.get('body_type')) for car in batch
+            )
+
+    async def sweep(self, source, body_type):
+        key = (source, body_type)
+        if not self.received.pop(key, 0):
+            return
+
+        if key in self.failed:
+            self.failed.discard(key)
+            print(
+                f'{datetime.now().strftime("%d-%m-%Y %H:%M:%S")} - [ SWEEP ] Skipped for the body {body_type}: some cars were not written.'
+            )
+            return
+
+        try:
+            await self.database.sweep_deleted(source, body_type)
+        except Exception as error:
+            print(
+                f'{datetime.now().strftime("%d-%m-%Y %H:%M:%S")} - [ SWEEP ERROR ] {error}'
+            )
+
+        print(
+            f'{datetime.now().strftime("%d-%m-%Y %H:%M:%S")} - [ POOL ] {self.database.pool_statistics()}'
+        )
@@ -1,11 +1,13 @@
 import asyncio
+import hashlib
 import re
 from datetime import datetime
 from math import ceil
 from pathlib import Path
 
-import aiofiles
-from bs4 import BeautifulSoup
+from configs import config
+from Parsers.markup import get_executor, parse_listing
+from Utils.worker_pool import WorkerPool
 
 ROOT_DIR = Path("share")
 ROOT_DIR.mkdir(exist_ok=True)
@@ -13,8 +15,8 @@ ROOT_DIR.mkdir(exist_ok=True)
 
 class ChachaParser:
     FILTER_URL = "https://www.kbchachacha.com/public/search/optionSale.json"
-    URL = "https://www.kbchachacha.com/public/search/list.empty?pageSize=6&useCode={code}&page={page}"
-    JSON_URL = "https://www.kbchachacha.com/public/car/common/recent/car/list.json?gotoPage=1&pageSize=1&carSeqVal={car_id}"
+    URL = "https://www.kbchachacha.com/public/search/list.empty"
+    JSON_URL = "https://www.kbchachacha.com/public/car/common/recent/car/list.json?gotoPage=1&pageSize={size}&carSeqVal={car_ids}"
     BODY_TYPES = {
         "002001": "경차",
         "002002": "소형",
@@ -28,45 +30,212 @@ class ChachaParser:
         "002010": "버스",
         "002011": "트럭",
     }
+    # Range filters used to shard oversized use codes, with the range each
+    # covers. sellAmt is in 10k won.
+    FACETS = (
+        ("sellAmt", 0, 100_000),
+        ("regiYear", 1990, 2030),
+    )
+    # Statuses the detail endpoint answers an oversized id list with; any
+    # other failure is the proxy or the site, not the batch size.
+    REJECTED_STATUSES = (400, 413, 414, 431)
 
-    def __init__(self, request_dispatcher, database):
+    def __init__(self, request_dispatcher, database, writer, state, photo_store):
         self.request_dispatcher = request_dispatcher
+        self.photo_store = photo_store
         self.database = database
+        self.writer = writer
+        self.state = state
+        self.executor = None
+        self.batch_size = config.kbchachacha.detail_batch
+        self.page_size = config.kbchachacha.page_size
 
     async def parse(self):
+        # Pages are parsed in a pool, so the event loop keeps serving
+        # requests while a page is being turned into records.
+        self.known = await self.database.load_known_cars() or set()
+        self.listings = self.state.get("kbchachacha_listings", {})
+        self.round = self.state.get("kbchachacha_verify_round", 0) + 1
+        self.listed = set()
+        with get_executor() as self.executor:
+            await self.parse_body_types()
+
+        # Cars that left the site are forgotten, so the index stays the size
+        # of the current inventory.
+        self.state.set(
+            "kbchachacha_listings",
+            {
+                car_id: listing
+                for car_id, listing in self.listings.items()
+                if car_id in self.listed
+            },
+        )
+        self.state.set("kbchachacha_verify_round", self.round)
+
+    async def parse_body_types(self):
+        # Read the counts and leave the response before crawling: an open
+        # response holds one of the host's limiter slots until it closes.
         async with self.request_dispatcher.get(self.FILTER_URL) as resp:
-            if resp.ok:
-                all_filters = await resp.json()
-                all_filters = all_filters["optionSale"]["result"]["useCode"]
-                for code, name in self.BODY_TYPES.items():
-                    if not (
-                        cars := await self.parse_cars_for_category(
-                            all_filters, code, name
-                        )
-                    ):
-                        continue
-
-                    tasks = []
-                    for car in cars.values():
-                        if len(tasks) == 30:
-                            await asyncio.gather(*tasks)
-                            tasks.clear()
-
-                        tasks.append(asyncio.create_task(self.parse_car(car)))
-
-                    await asyncio.gather(*tasks)
-                    tasks.clear()
-
-                    await self.database.cars_processing(list(cars.values()))
+            if resp is None or not resp.ok:
+                return
+
+            all_filters = await resp.json()
+
+        all_filters = all_filters["optionSale"]["result"]["useCode"]
+        await self.probe_page_size(all_filters)
+        for code, name in self.BODY_TYPES.items():
+            cars, complete = await self.parse_cars_for_category(
+                all_filters, code, name
+            )
+            if not cars:
+                continue
+
+            self.listed.update(str(car_id) for car_id in cars)
+            cars, unchanged = await self.select_changed(cars.values(), name)
+            if unchanged:
+                await self.writer.seen("kbchachacha", name, unchanged)
+
+            async with WorkerPool(config.workers.size) as photos:
+                async with WorkerPool(config.workers.size) as pool:
+                    index = 0
+                    while index < len(cars):
+                        # Read the size per batch, so batches submitted
+                        # after a failure already use the smaller size.
+                        batch = cars[index:index + self.batch_size]
+                        index += len(batch)
+                        await pool.submit(self.parse_batch(batch, photos))
+
+            for car in cars:
+                if car.get("deleted_at") or car.get("unfetched"):
+                    # An unfetched car is looked up again next run.
+                    self.listings.pop(str(car["id"]), None)
+                else:
+                    self.listings[str(car["id"])] = car["listing"]
+
+            if not complete:
+                # Cars on the missing pages were not seen this run;
+                # sweeping now would delete them.
+                print(
+                    f"{await self.time()} - [ SWEEP ] Skipped for the body {name}: some pages were not crawled."
+                )
+                continue
+
+            await self.writer.finish_body_type("kbchachacha", name)
+
+    async def select_changed(self, cars, name):
+        # A car already in the database whose listing card looks the same as
+        # last run is only marked as seen. A rotating sample of them still
+        # gets a detail lookup, so sold cars that stay listed are caught and
+        # every car is verified once per verify_rounds runs.
+        changed, unchanged = [], []
+        rounds = config.kbchachacha.verify_rounds
+        for car in cars:
+            if (
+                car["id"] in self.known
+                and self.listings.get(str(car["id"])) == car["listing"]
+                and car["id"] % rounds != self.round % rounds
+            ):
+                unchanged.append(car["id"])
+            else:
+                changed.append(car)
+
+        print(
+            f"{await self.time()} - [ KNOWN ] {name} - {len(unchanged)} unchanged, {len(changed)} to fetch"
+        )
+        return changed, unchanged
+
+    async def parse_batch(self, cars, photos):
+        if len(cars) == 1:
+            await self.parse_car(cars[0])
+            await photos.submit(self.store_car(cars[0]))
+            return
+
+        details = await self.get_details(cars)
+        if details is None:
+            # The lookup kept failing, which says nothing about the batch
+            # size; leave the cars as they are until the next run.
+            for car in cars:
+                car["unfetched"] = True
+                await photos.submit(self.store_car(car))
+
+            return
+
+        # An endpoint that ignores all but one id answers a batch with a
+        # single car; treat that the same as a rejected batch.
+        if len(details) * 2 < len(cars):
+            # The endpoint refused this many ids: halve the batch for the
+            # rest of the run and retry both halves.
+            middle = len(cars) // 2
+            if middle < self.batch_size:
+                self.batch_size = middle
+                print(
+                    f"{await self.time()} - [ BATCH ] Detail batch size lowered to {middle}"
+                )
+
+            await self.parse_batch(cars[:middle], photos)
+            await self.parse_batch(cars[middle:], photos)
+            return
+
+        for car in cars:
+            if detail := details.get(car["id"]):
+                await self.apply_detail(car, detail)
+            else:
+                # Missing from the batch usually means sold; a single lookup
+                # confirms it before the car is marked as deleted.
+                await self.parse_car(car)
+
+            await photos.submit(self.store_car(car))
+
+    async def get_details(self, cars):
+        # Returns the details by car id, empty if the endpoint rejected the
+        # batch, or None if the lookup itself kept failing.
+        attempts = 2
+        while True:
+            try:
+                async with self.request_dispatcher.post(
+                    self.JSON_URL.format(
+                        size=len(cars),
+                        car_ids=",".join(str(car["id"]) for car in cars),
+                    )
+                ) as resp:
+                    if resp is not None and resp.status in self.REJECTED_STATUSES:
+                        return {}
+
+                    if resp is not None and resp.ok:
+                        json = await resp.json()
+                        return {
+                            int(detail["carSeq"]): detail for detail in json["list"]
+                        }
+
+            except Exception as error:
+                print(f"{await self.time()} - [ ERROR ] {error}")
+
+            if attempts == 0:
+                return None
+
+            await asyncio.sleep(2)
+            attempts -= 1
+
+    async def store_car(self, car):
+        if car.get("unfetched"):
+            # Without details the row is left as it is, but the car is still
+            # listed, so the sweep must keep it.
+            await self.writer.seen("kbchachacha", car["body_type"], [car["id"]])
+            return
+
+        if not car.get("deleted_at"):
+            car["preview"] = await self.download_photo(car.get("preview"), car["id"])
+
+        await self.writer.put(car)
 
     async def parse_car(self, car):
         attempts = 2
         while True:
             try:
                 async with self.request_dispatcher.post(
-                    self.JSON_URL.format(car_id=car["id"])
+                    self.JSON_URL.format(size=1, car_ids=car["id"])
                 ) as resp:
-                    if resp.ok:
+                    if resp is not None and resp.ok:
                         json = await resp.json()
                         if not json["list"]:
                             print(
@@ -75,108 +244,236 @@ class ChachaParser:
                             car["deleted_at"] = True
                             return
 
-                        json = json["list"][0]
-                        car["mark"] = json["makerName"]
-                        car["model"] = json["className"]
-                        car["grade"] = f'{json["modelName"]} {json["gradeName"]}'.strip()
-                        car["gearbox"] = None
-                        car["preview"] = await self.download_photo(
-                            car.get("preview"), car["id"]
-                        )
-
-                        if match := re.search(
-                            "(?P<transmission>AWD|RWD|FWD|2WD|4WD)", car["grade"]
-                        ):
-                            car["transmission"] = match.group("transmission")
-                        else:
-                            car["transmission"] = None
-
-                        if match := re.search(r"(?P<vol>\d{1,2}\.\d{1})", car["grade"]):
-                            car["engine"] = int(float(match.group("vol")) * 1_000)
-                        else:
-                            car["engine"] = None
-
-                        car["year"] = int(json["yymm"])
-                        car["fuel"] = None
-                        car["mileage"] = json["km"]
-                        car["price"] = json["sellAmt"] * 10_000
+                        await self.apply_detail(car, json["list"][0])
                         return
 
             except Exception as error:
                 print(f'{await self.time()} - [ ERROR ] {error}')
-                if attempts == 0:
-                    car["deleted_at"] = True
-                    return
 
-                await asyncio.sleep(2)
-                attempts -= 1
+            if attempts == 0:
+                # Only an empty answer means sold; a failed lookup says
+                # nothing about the listing.
+                car["unfetched"] = True
+                return
 
-    async def download_photo(self, url, car_id):
-        car_dir = ROOT_DIR.joinpath(f"kbchachacha_{car_id}")
-        car_dir.mkdir(parents=True, exist_ok=True)
-        attempts = 2
-        while True:
-            try:
-                async with self.request_dispatcher.get(url) as resp:
-                    if resp.ok:
-                        path_to_photo = car_dir.joinpath(Path(url).name)
-                        async with aiofiles.open(path_to_photo, "wb") as f:
-                            await f.write(await resp.read())
+            await asyncio.sleep(2)
+            attempts -= 1
 
-                        return str(path_to_photo)
+    @staticmethod
+    async def apply_detail(car, json):
+        car["mark"] = json["makerName"]
+        car["model"] = json["className"]
+        car["grade"] = f'{json["modelName"]} {json["gradeName"]}'.strip()
+        car["gearbox"] = None
 
-            except Exception as error:
-                if attempts == 0:
-                    return None
+        if match := re.search(
+            "(?P<transmission>AWD|RWD|FWD|2WD|4WD)", car["grade"]
+        ):
+            car["transmission"] = match.group("transmission")
+        else:
+            car["transmission"] = None
 
-                print(f'{await self.time()} - [ ERROR ] {error}')
-                await asyncio.sleep(3)
-                attempts -= 1
+        if match := re.search(r"(?P<vol>\d{1,2}\.\d{1})", car["grade"]):
+            car["engine"] = int(float(match.group("vol")) * 1_000)
+        else:
+            car["engine"] = None
+
+        car["year"] = int(json["yymm"])
+        car["fuel"] = None
+        car["mileage"] = json["km"]
+        car["price"] = json["sellAmt"] * 10_000
+
+    async def download_photo(self, url, car_id):
+        if not url:
+            return None
+
+        return await self.photo_store.get(
+            url, ROOT_DIR.joinpath(f"kbchachacha_{car_id}", Path(url).name)
+        )
 
     async def parse_cars_for_category(self, filter, code, name):
-        cars = []
         total = filter.get(code)
-        pages = await self.calculate_pages(total)
-        if not pages:
-            return
+        if not total:
+            return {}, True
+
+        shards = await self.split_shard(
+            {"code": code, "params": {}, "ranges": (), "total": total}
+        )
+        print(f"{await self.time()} - [ SHARDS ] {name} - {len(shards)}")
+        # A shard past the page cap cannot be listed to the end.
+        complete = all(
+            ceil(shard["total"] / self.page_size) <= config.kbchachacha.max_pages
+            for shard in shards
+        )
+        if (found := sum(shard["total"] for shard in shards)) < total:
+            # The range shards miss cars the use code holds, e.g. when a
+            # range bound is not inclusive; the sweep would delete them.
+            print(
+                f"{await self.time()} - [ SHARDS ] {name} - {found} of {total} cars covered"
+            )
+            complete = False
+
+        async with WorkerPool(config.workers.size) as pool:
+            for shard in shards:
+                for page in range(1, await self.calculate_pages(shard["total"]) + 1):
+                    await pool.submit(self.parse_car_on_page(shard, name, page))
+
+        # Shard boundaries may overlap on the site's side, so cars are merged
+        # by data-car-seq.
+        cars = {k: v for batch in pool.results if batch for k, v in batch.items()}
+        return cars, complete and not pool.errors and None not in pool.results
+
+    async def count_shard(self, shard):
+        async with self.request_dispatcher.get(
+            self.FILTER_URL, params=self.shard_params(shard)
+        ) as resp:
+            if resp is None or not resp.ok:
+                return None
 
-        tasks = []
-        for page in range(1, pages + 1):
-            if len(tasks) == 30:
-                cars += await asyncio.gather(*tasks)
-                tasks.clear()
+            result = (await resp.json())["optionSale"]["result"]
 
-            tasks.append(asyncio.create_task(self.parse_car_on_page(code, name, page)))
+        shard["total"] = result["useCode"].get(shard["code"], 0)
+        makers = result.get("makerCode")
+        shard["makers"] = makers if isinstance(makers, dict) else None
+        return shard
 
-        cars += await asyncio.gather(*tasks)
-        tasks.clear()
+    def shard_params(self, shard):
+        params = {"useCode": shard["code"], **shard["params"]}
+        for facet, lo, hi in shard["ranges"]:
+            name, facet_lo, facet_hi = self.FACETS[facet]
+            if lo != facet_lo:
+                params[f"{name}From"] = lo
 
-        return {k: v for batch in cars if batch for k, v in batch.items()}
+            if hi != facet_hi:
+                params[f"{name}To"] = hi
 
-    async def parse_car_on_page(self, code, body_type, page):
+        return params
+
+    async def split_shard(self, shard):
+        # The list stops at max_pages pages, so an oversized use code is cut
+        # by maker, then by price and year ranges, until every shard can be
+        # paged to the end.
+        if ceil(shard["total"] / self.page_size) <= config.kbchachacha.max_pages:
+            return [shard]
+
+        if "makerCode" not in shard["params"]:
+            if "makers" not in shard:
+                await self.count_shard(shard)
+
+            makers = shard.get("makers")
+            # Cars without a maker facet would fall out of a maker split.
+            if makers and sum(makers.values()) >= shard["total"]:
+                children = [
+                    {
+                        **shard,
+                        "params": {**shard["params"], "makerCode": maker},
+                        "total": total,
+                    }
+                    for maker, total in makers.items()
+                    if total
+                ]
+                nested = await asyncio.gather(
+                    *(self.split_shard(child) for child in children)
+                )
+                return [child for group in nested for child in group]
+
+        ranges = self.split_ranges(shard["ranges"])
+        if ranges is None:
+            print(
+                f'{await self.time()} - [ SHARDS ] {self.shard_params(shard)} cannot be split below {shard["total"]} cars'
+            )
+            return [shard]
+
+        children = await asyncio.gather(
+            *(
+                self.count_shard(
+                    {"code": shard["code"], "params": shard["params"], "ranges": child}
+                )
+                for child in ranges
+            )
+        )
+        if None in children:
+            # Without the counts the split cannot be trusted; crawl what the
+            # unsplit shard gives instead.
+            return [shard]
+
+        nested = await asyncio.gather(
+            *(self.split_shard(child) for child in children if child["total"])
+        )
+        return [child for group in nested for child in group]
+
+    def split_ranges(self, ranges):
+        if ranges and ranges[-1][2] > ranges[-1][1]:
+            base, (facet, lo, hi) = ranges[:-1], ranges[-1]
+        else:
+            base, facet = ranges, ranges[-1][0] + 1 if ranges else 0
+            if facet == len(self.FACETS):
+                return None
+
+            _, lo, hi = self.FACETS[facet]
+
+        middle = (lo + hi) // 2
+        return [base + ((facet, lo, middle),), base + ((facet, middle + 1, hi),)]
+
+    async def probe_page_size(self, totals):
+        # The site silently serves fewer cars than pageSize asks for past
+        # its own limit; the first page of the biggest use code shows the
+        # size it actually serves.
+        self.page_size = config.kbchachacha.page_size
+        code = max(totals, key=lambda code: totals[code] or 0)
+        cars = await self.parse_car_on_page(
+            {"code": code, "params": {}, "ranges": ()}, None, 1
+        )
+        if cars and len(cars) < min(self.page_size, totals[code]):
+            self.page_size = len(cars)
+
+        print(f"{await self.time()} - [ PAGE SIZE ] {self.page_size}")
+
+    async def parse_car_on_page(self, shard, body_type, page):
         try:
             async with self.request_dispatcher.get(
-                self.URL.format(code=code, page=page)
+                self.URL,
+                params={
+                    **self.shard_params(shard),
+                    "pageSize": self.page_size,
+                    "page": page,
+                },
             ) as resp:
-                soup = BeautifulSoup(await resp.read(), "html.parser")
-                general_cars = soup.find("div", class_="generalRegist")
-                return {
-                    int(car["data-car-seq"]): {
-                        "source": "kbchachacha",
-                        "id": int(car["data-car-seq"]),
-                        "preview": car.find("img")["src"].replace("?width=360", ""),
-                        "body_type": body_type,
-                    }
-                    for car in general_cars.find_all("div", class_="area")
+                content = await resp.read()
+
+            # Parsed after the response is closed: an open response holds
+            # one of the host's limiter slots while the page waits for the
+            # pool.
+            listing = await self.read_listing(content)
+            return {
+                int(car["seq"]): {
+                    "source": "kbchachacha",
+                    "id": int(car["seq"]),
+                    "preview": car["image"].replace("?width=360", ""),
+                    "body_type": body_type,
+                    "listing": self.listing_fingerprint(car),
                 }
-        except AttributeError as error:
+                for car in listing
+            }
+        except (AttributeError, TypeError) as error:
             print(f'{await self.time()} - [ ATTRIBUTE ERROR ] {error}')
             return None
 
+    @staticmethod
+    def listing_fingerprint(car):
+        # The card shows price, mileage and year next to the photo, so a
+        # change to any of them changes its text or its image.
+        return hashlib.md5(f'{car["text"]}\x1f{car["image"]}'.encode()).hexdigest()
+
+    async def read_listing(self, content):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, parse_listing, content
+        )
+
     async def calculate_pages(self, total):
-        pages = ceil(total / 50)
-        if pages > 60:
-            pages = 60
+        pages = ceil(total / self.page_size)
+        if pages > config.kbchachacha.max_pages:
+            pages = config.kbchachacha.max_pages
 
         print(f'{await self.time()} - [ TOTAL PAGES ] {pages}')
         return pages
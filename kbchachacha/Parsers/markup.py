@@ -0,0 +1,122 @@
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from time import perf_counter
+
+from bs4 import BeautifulSoup, UnicodeDammit
+from configs import config
+from lxml import html as lxml_html
+from lxml.etree import ParserError
+
+
+# Text nodes BeautifulSoup's strings count: those outside script, style and
+# template elements.
+TEXT = ".//text()[not(ancestor::script or ancestor::style or ancestor::template)]"
+
+
+def has_class(*names):
+    return " and ".join(
+        f'contains(concat(" ", normalize-space(@class), " "), " {name} ")'
+        for name in names
+    )
+
+
+class SoupMarkup:
+    name = "bs4"
+
+    def listing(self, content):
+        soup = BeautifulSoup(content, "html.parser")
+        general_cars = soup.find("div", class_="generalRegist")
+        if general_cars is None:
+            return None
+
+        return [
+            {
+                "seq": car.get("data-car-seq"),
+                "image": image.get("src") if (image := car.find("img")) else None,
+                "text": " ".join(car.stripped_strings),
+            }
+            for car in general_cars.find_all("div", class_="area")
+        ]
+
+
+class LxmlMarkup:
+    # Same extraction as SoupMarkup, but the tree is built by libxml2 and
+    # searched with XPath, which is several times faster than html.parser.
+    name = "lxml"
+
+    def listing(self, content):
+        # libxml2 falls back to latin-1 for pages without a charset meta;
+        # decode the way BeautifulSoup does so both see the same text.
+        try:
+            tree = lxml_html.document_fromstring(
+                UnicodeDammit(content, is_html=True).unicode_markup
+            )
+        except ParserError:
+            # An empty body; html.parser gives an empty soup for it.
+            return None
+
+        general_cars = tree.xpath(f'//div[{has_class("generalRegist")}]')
+        if not general_cars:
+            return None
+
+        return [
+            {
+                "seq": car.get("data-car-seq"),
+                "image": image[0].get("src")
+                if (image := car.xpath(".//img"))
+                else None,
+                "text": " ".join(
+                    text.strip() for text in car.xpath(TEXT) if text.strip()
+                ),
+            }
+            for car in general_cars[0].xpath(f'.//div[{has_class("area")}]')
+        ]
+
+
+BACKENDS = {backend.name: backend for backend in (SoupMarkup, LxmlMarkup)}
+
+
+def parse_listing(content, name=None):
+    # Runs inside the parse pool: plain bytes in, plain records out.
+    return BACKENDS[name or config.html.backend]().listing(content)
+
+
+def get_executor():
+    # lxml releases the GIL while it builds the tree, so threads are enough
+    # for it; html.parser is pure Python and needs processes.
+    if config.html.pool == "thread":
+        return ThreadPoolExecutor(config.html.workers)
+
+    return ProcessPoolExecutor(config.html.workers)
+
+
+def main(paths):
+    # Parity check and benchmark over saved listing pages:
+    #   python -m Parsers.markup samples/*.html
+    if not paths:
+        print("Usage: python -m Parsers.markup PAGE.html [PAGE.html ...]")
+        return False
+
+    pages = [Path(path).read_bytes() for path in paths]
+    results = {}
+    for name, backend in BACKENDS.items():
+        markup = backend()
+        start = perf_counter()
+        results[name] = [markup.listing(page) for page in pages]
+        elapsed = perf_counter() - start
+        print(f"[ BENCHMARK ] {name}: {len(pages) / elapsed:.1f} pages/s")
+
+    ok = True
+    reference, *others = BACKENDS
+    for name in others:
+        for path, expected, actual in zip(paths, results[reference], results[name]):
+            if expected != actual:
+                ok = False
+                print(f"[ PARITY ] {path}: {reference} and {name} differ")
+
+    return ok
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main(sys.argv[1:]) else 1)
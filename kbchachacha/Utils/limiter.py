@@ -0,0 +1,100 @@
+import asyncio
+from collections import deque
+from time import monotonic
+from urllib.parse import urlsplit
+
+from configs import config
+
+
+class AIMDLimiter:
+    def __init__(
+        self,
+        initial,
+        minimum,
+        maximum,
+        increase,
+        decrease,
+        latency_target,
+    ):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.waiters = deque()
+
+    async def acquire(self):
+        while self.in_flight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self.wake()
+                raise
+            finally:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+
+        self.in_flight += 1
+
+    def release(self, latency=None, healthy=True):
+        self.in_flight -= 1
+        if latency is not None or not healthy:
+            self.feedback(latency, healthy)
+
+        self.wake()
+
+    def wake(self):
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    def feedback(self, latency, healthy):
+        if healthy and latency <= self.latency_target:
+            # Additive increase: roughly +increase per full window of requests.
+            self.limit = min(
+                self.maximum, self.limit + self.increase / self.limit
+            )
+            return
+
+        # Multiplicative decrease, at most once per latency window, so one
+        # burst of failures from the same window does not collapse the limit.
+        now = monotonic()
+        if now - self.last_decrease < self.latency_target:
+            return
+
+        self.last_decrease = now
+        self.limit = max(self.minimum, self.limit * self.decrease)
+
+
+class HostLimiter:
+    def __init__(self):
+        self.limiters = dict()
+
+    def get(self, url):
+        host = urlsplit(url).hostname
+        if host not in self.limiters:
+            self.limiters[host] = AIMDLimiter(
+                initial=config.limiter.initial,
+                minimum=config.limiter.minimum,
+                maximum=config.limiter.maximum,
+                increase=config.limiter.increase,
+                decrease=config.limiter.decrease,
+                latency_target=config.limiter.latency_target,
+            )
+
+        return self.limiters[host]
+
+    def limits(self):
+        return {
+            host: (int(limiter.limit), limiter.in_flight)
+            for host, limiter in self.limiters.items()
+        }
@@ -0,0 +1,55 @@
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+from time import time
+
+import aiofiles
+from configs import config
+
+STATE_VERSION = 1
+
+
+class StateStore:
+    def __init__(self):
+        self.path = Path(config.state.path).joinpath(f"{config.source}.json")
+        self.state = self.load()
+
+    def load(self):
+        try:
+            state = json.loads(self.path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return dict()
+
+        if state.get("version") != STATE_VERSION:
+            return dict()
+
+        if time() - state.get("saved_at", 0) > config.state.max_age:
+            return dict()
+
+        print(
+            f'{datetime.now().strftime("%d-%m-%Y %H:%M:%S")} - [ STATE ] Warm start from {self.path}'
+        )
+        return state
+
+    def get(self, key, default=None):
+        return self.state.get(key, default)
+
+    def set(self, key, value):
+        self.state[key] = value
+
+    async def save(self):
+        self.state["version"] = STATE_VERSION
+        self.state["saved_at"] = time()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp")
+        try:
+            async with aiofiles.open(tmp_path, "w", encoding="utf-8") as f:
+                await f.write(json.dumps(self.state, ensure_ascii=False))
+
+            os.replace(tmp_path, self.path)
+
+        except OSError as error:
+            print(
+                f'{datetime.now().strftime("%d-%m-%Y %H:%M:%S")} - [ STATE ERROR ] {error}'
+            )
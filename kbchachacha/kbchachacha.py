@@ -4,9 +4,12 @@ from time import time as t
 
 from aiohttp import ClientSession
 from Database.sa_database import Database
+from Database.write_queue import WriteBehindQueue
 from Parsers.chacha import ChachaParser
+from Utils.photo_store import PhotoStore
 from Utils.proxy_dispatcher import ProxyDispatcher
 from Utils.request_dispatcher import RequestDispatcher
+from Utils.state_store import StateStore
 
 
 async def time():
@@ -14,26 +17,46 @@ async def time():
 
 
 async def main():
+    state = StateStore()
     proxy_dispatcher = ProxyDispatcher()
     async with ClientSession() as session:
+        await proxy_dispatcher.start(session, state)
         request_dispatcher = RequestDispatcher(
             session=session,
             proxy_dispatcher=proxy_dispatcher
         )
         database = Database()
+        await database.start(state)
+        writer = WriteBehindQueue(database)
+        await writer.start()
+        photo_store = PhotoStore(request_dispatcher)
+        photo_store.start(state)
 
         parser = ChachaParser(
             request_dispatcher=request_dispatcher,
-            database=database
+            database=database,
+            writer=writer,
+            photo_store=photo_store,
+            state=state,
         )
         try:
             await database.update_monitoring(None)
             await parser.parse()
+            await writer.stop()
             await database.update_monitoring(True)
         except Exception as error:
             print(f'{await time()} - [ ERROR ] {error}')
             await database.update_monitoring(False)
 
+        finally:
+            await proxy_dispatcher.stop()
+            await writer.stop()
+            await database.stop()
+            state.set('proxy_pool', proxy_dispatcher.snapshot())
+            state.set('dimensions', database.snapshot())
+            state.set('photos', photo_store.snapshot())
+            await state.save()
+
 
 if __name__ == '__main__':
     start = t()
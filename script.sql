@@ -130,8 +130,10 @@ create table if not exists cars (
     seller json COMMENT 'Хранит данные по продавцу в виде JSON. Пример {"name": "Alex Yun", "phone": "0503159674", "address": "Almaty, Abay 150"}',
     tech_inspection_url json,
     insurance_url json,
+    fingerprint char(32) COMMENT 'MD5 нормализованных полей, по нему пропускаются неизменившиеся машины.',
     created_at timestamp NULL DEFAULT CURRENT_TIMESTAMP,
     updated_at timestamp NULL DEFAULT CURRENT_TIMESTAMP,
+    last_seen_at timestamp NULL COMMENT 'Время запуска парсера, в котором машина была найдена последний раз.',
     deleted_at date COMMENT 'Записывается дата обнаружения удаления машины.',
     foreign key (source_site_id) references car_source_site(id) on update cascade on delete cascade,
     foreign key (body_id) references car_body(id) on update cascade on delete cascade,
@@ -142,7 +144,12 @@ create table if not exists cars (
     foreign key (fuel_type_id) references car_fuel_type (id) on update cascade on delete cascade,
     foreign key (color_id) references car_color (id) on update cascade on delete cascade
 ) COMMENT='Таблица, которая данные автомобиля.';
-create unique index uniq_car on car(source_site_id, car_id);
+create unique index uniq_car on cars(source_site_id, car_id);
+create index idx_cars_sweep on cars(source_site_id, body_id, deleted_at, last_seen_at);
+create index idx_cars_mark_model on cars(deleted_at, mark_id, model_id);
+create index idx_cars_body on cars(deleted_at, body_id);
+create index idx_cars_price on cars(deleted_at, price);
+create index idx_cars_year on cars(deleted_at, year);
 
 create table if not exists car_options (
     id bigint unsigned primary key auto_increment,